@@ -1,9 +1,18 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 
-from .models import GennotesEditor, GenomeReport
+from .models import ClinVarRefresh, GennotesEditor, GenomeReport
 
 User = get_user_model()
 
 admin.site.register(GennotesEditor)
 admin.site.register(GenomeReport)
+
+
+@admin.register(ClinVarRefresh)
+class ClinVarRefreshAdmin(admin.ModelAdmin):
+    list_display = ('clinvar_release', 'started', 'paused', 'progress',
+                    'finished')
+    list_editable = ('paused',)
+    readonly_fields = ('last_report_id', 'reports_total', 'reports_queued',
+                       'finished')
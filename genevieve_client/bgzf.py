@@ -0,0 +1,179 @@
+"""Block-gzipped (BGZF) genome files with a position index for random access"""
+from array import array
+from bisect import bisect_left
+import io
+import os
+import struct
+import zlib
+
+from .clinvar_index import position_key
+from .genome_scan import CONTIG_INDEX, scan_genome
+
+# Largest uncompressed payload of a BGZF block, as used by htslib. This
+# guarantees the compressed block fits the 16-bit BSIZE field.
+BGZF_MAX_BLOCK_DATA = 65280
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Index file layout, see write_indexed_genome.
+INDEX_FILE_MAGIC = b'GVBGZIX\x00'
+INDEX_FILE_VERSION = 1
+INDEX_FILE_HEADER = struct.Struct('<8sH6xQ')
+INDEX_ENTRY_FIELDS = 5
+
+
+def _write_bgzf_block(f, data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    f.write(BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                             ord('B'), ord('C'), 2, len(cdata) + 25))
+    f.write(cdata)
+    f.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def _line_key(line):
+    if line.startswith(b'#'):
+        return None
+    fields = line.split(b'\t', 2)
+    chrom = CONTIG_INDEX.get(fields[0])
+    if not chrom or len(fields) < 3:
+        return None
+    try:
+        return position_key(chrom, int(fields[1]))
+    except ValueError:
+        return None
+
+
+def write_indexed_genome(genome_in, bgzf_filepath, group_lines=64):
+    """
+    Transcode a genome VCF (binary file object) to BGZF, with a position index.
+
+    Lines are indexed in groups of group_lines. Each index entry holds the
+    group's smallest and largest (chrom, pos) key, the file offset of the
+    BGZF block the group starts in, the group's offset within that block's
+    data and its length. Groups never straddle blocks, unless a group alone
+    is too large for one block, in which case it starts a run of blocks.
+
+    The index is written to bgzf_filepath + '.idx': a header (magic, format
+    version and entry count) followed by entries as native 64-bit unsigned
+    integers. Both files are written under temporary names, then renamed.
+    """
+    tmp_bgzf_filepath = '{}.tmp{}'.format(bgzf_filepath, os.getpid())
+    index_filepath = bgzf_filepath + '.idx'
+    tmp_index_filepath = '{}.tmp{}'.format(index_filepath, os.getpid())
+    entries = array('Q')
+
+    with open(tmp_bgzf_filepath, 'wb') as bgzf_out:
+        block_start = 0
+        pending = []
+        pending_size = 0
+
+        def write_pending():
+            data = b''.join(pending)
+            for i in range(0, len(data), BGZF_MAX_BLOCK_DATA):
+                _write_bgzf_block(bgzf_out,
+                                  data[i:i + BGZF_MAX_BLOCK_DATA])
+
+        def add_group(lines, keys):
+            nonlocal block_start, pending, pending_size
+            group = b''.join(lines)
+            if pending and pending_size + len(group) > BGZF_MAX_BLOCK_DATA:
+                write_pending()
+                block_start = bgzf_out.tell()
+                pending, pending_size = [], 0
+            # Groups without variant lines (e.g. the header) aren't indexed.
+            if keys:
+                entries.extend([min(keys), max(keys), block_start,
+                                pending_size, len(group)])
+            pending.append(group)
+            pending_size += len(group)
+
+        lines, keys = [], []
+        for line in genome_in:
+            lines.append(line)
+            key = _line_key(line)
+            if key is not None:
+                keys.append(key)
+            if len(lines) >= group_lines:
+                add_group(lines, keys)
+                lines, keys = [], []
+        if lines:
+            add_group(lines, keys)
+        if pending:
+            write_pending()
+        bgzf_out.write(BGZF_EOF)
+
+    with open(tmp_index_filepath, 'wb') as index_out:
+        index_out.write(INDEX_FILE_HEADER.pack(
+            INDEX_FILE_MAGIC, INDEX_FILE_VERSION,
+            len(entries) // INDEX_ENTRY_FIELDS))
+        entries.tofile(index_out)
+
+    os.rename(tmp_bgzf_filepath, bgzf_filepath)
+    os.rename(tmp_index_filepath, index_filepath)
+
+
+def load_genome_index(bgzf_filepath):
+    """
+    Return index entries for a file written by write_indexed_genome.
+
+    Raises ValueError if the index isn't readable, IOError if it's missing.
+    """
+    index_filepath = bgzf_filepath + '.idx'
+    with open(index_filepath, 'rb') as f:
+        header = f.read(INDEX_FILE_HEADER.size)
+        if len(header) < INDEX_FILE_HEADER.size:
+            raise ValueError('Truncated genome index file: ' + index_filepath)
+        magic, version, count = INDEX_FILE_HEADER.unpack(header)
+        if magic != INDEX_FILE_MAGIC or version != INDEX_FILE_VERSION:
+            raise ValueError(
+                'Unrecognized genome index file: ' + index_filepath)
+        entries = array('Q')
+        try:
+            entries.fromfile(f, count * INDEX_ENTRY_FIELDS)
+        except EOFError:
+            raise ValueError('Truncated genome index file: ' + index_filepath)
+    return [tuple(entries[i:i + INDEX_ENTRY_FIELDS]) for
+            i in range(0, len(entries), INDEX_ENTRY_FIELDS)]
+
+
+def _read_bgzf_data(f, block_start, size):
+    """
+    Decompress BGZF blocks from block_start until size bytes are available.
+    """
+    f.seek(block_start)
+    data = []
+    data_size = 0
+    while data_size < size:
+        header = f.read(BGZF_HEADER.size)
+        if len(header) < BGZF_HEADER.size:
+            break
+        block_size = BGZF_HEADER.unpack(header)[-1] + 1
+        block = header + f.read(block_size - BGZF_HEADER.size)
+        data.append(zlib.decompress(block, 31))
+        data_size += len(data[-1])
+    return b''.join(data)
+
+
+def scan_indexed_genome(bgzf_filepath, clinvar_sig, stats=None):
+    """
+    Yield ClinVar hits from an indexed BGZF genome, reading only what's needed.
+
+    Line groups are only decompressed and scanned if their key range contains
+    a ClinVar position, so stats only count records in those groups.
+    """
+    clinvar_keys = clinvar_sig.keys
+    entries = load_genome_index(bgzf_filepath)
+    with open(bgzf_filepath, 'rb') as f:
+        run_start, run_data = None, b''
+        for min_key, max_key, block_start, offset, size in entries:
+            i = bisect_left(clinvar_keys, min_key)
+            if i >= len(clinvar_keys) or clinvar_keys[i] > max_key:
+                continue
+            if block_start != run_start or len(run_data) < offset + size:
+                run_start = block_start
+                run_data = _read_bgzf_data(f, block_start, offset + size)
+            group = io.BytesIO(run_data[offset:offset + size])
+            for hit in scan_genome(group, clinvar_sig, stats):
+                yield hit
@@ -9,6 +9,7 @@ from __future__ import absolute_import
 import os
 
 from celery import Celery
+from celery.signals import worker_process_init
 
 from django.conf import settings
 
@@ -28,3 +29,22 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
+
+
+@worker_process_init.connect
+def warm_clinvar_data(**kwargs):
+    """
+    Load ClinVar data already on disk as a genome processing worker starts.
+
+    Only 'parse' queue workers use it. Nothing is downloaded or generated
+    here, as a process slow to start is killed (setup_clinvar_data does
+    that for the first task, when needed).
+    """
+    if 'parse' not in app.amqp.queues.consume_from:
+        return
+    from .tasks import load_local_clinvar_data
+    try:
+        load_local_clinvar_data()
+    except Exception as e:
+        # Tasks will retry the load; don't keep the worker from starting.
+        print('Unable to preload ClinVar data: {}'.format(e))
@@ -0,0 +1,166 @@
+"""Compact lookup index for ClinVar 'significant variants'"""
+from array import array
+from bisect import bisect_left, bisect_right
+import mmap
+import os
+import struct
+
+# Binary index file layout, see ClinVarIndex.save.
+INDEX_FILE_MAGIC = b'GVCVIDX\x00'
+INDEX_FILE_VERSION = 1
+INDEX_FILE_HEADER = struct.Struct('<8sH6x8s32sQQ')
+
+
+def position_key(chrom, pos):
+    """
+    Encode a chromosome index and position as a single sortable integer.
+    """
+    return (chrom << 32) | pos
+
+
+class ClinVarIndex(object):
+    """
+    Sorted, array-backed set of (chrom, pos, ref_allele, var_allele) variants.
+
+    Positions are held as integer keys (see position_key) in a typed array,
+    sorted so lookups are a binary search. Alleles are packed into a single
+    bytes table as 'REF<tab>ALT' entries, with an offsets array locating the
+    entry for each key. Chromosomes are integer indexes as used by
+    vcf2clinvar's CHROM_INDEX (and the Variant model).
+
+    An index can be saved to a binary file and loaded back with mmap, so
+    worker processes share one copy of it through the OS page cache.
+    """
+    # Identifies files of this class, see save.
+    file_magic = INDEX_FILE_MAGIC
+
+    def __init__(self, keys, allele_offsets, alleles, build='', release='',
+                 filepath=None):
+        self.keys = keys
+        self.allele_offsets = allele_offsets
+        self.alleles = alleles
+        self.build = build
+        self.release = release
+        self.filepath = filepath
+
+    @classmethod
+    def from_variants(cls, variants, build='', release=''):
+        """
+        Build an index from (chrom, pos, ref_allele, var_allele) tuples.
+
+        Any further values in the tuples are stored with the alleles.
+        """
+        entries = sorted(set(
+            (position_key(variant[0], variant[1]),
+             '\t'.join(variant[2:]).encode())
+            for variant in variants))
+        keys = array('Q', [key for key, _ in entries])
+        allele_offsets = array('Q', [0])
+        for _, allele_pair in entries:
+            allele_offsets.append(allele_offsets[-1] + len(allele_pair))
+        alleles = b''.join(allele_pair for _, allele_pair in entries)
+        return cls(keys, allele_offsets, alleles, build, release)
+
+    def save(self, filepath):
+        """
+        Write the index to a binary file.
+
+        The file is a fixed header (magic, format version, build, release,
+        key count and allele table size) followed by the keys and allele
+        offsets as native 64-bit unsigned integers, then the allele table.
+        It's written to a temporary file and renamed into place, so readers
+        never see a partial file.
+        """
+        tmp_filepath = '{}.tmp{}'.format(filepath, os.getpid())
+        with open(tmp_filepath, 'wb') as f:
+            f.write(INDEX_FILE_HEADER.pack(
+                self.file_magic, INDEX_FILE_VERSION,
+                self.build.encode(), self.release.encode(),
+                len(self.keys), len(self.alleles)))
+            array('Q', self.keys).tofile(f)
+            array('Q', self.allele_offsets).tofile(f)
+            f.write(self.alleles)
+        os.rename(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Memory-map an index file written by save.
+
+        Raises ValueError if the file isn't a readable index of this version.
+        """
+        with open(filepath, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) < INDEX_FILE_HEADER.size:
+            raise ValueError('Truncated {} file: {}'.format(
+                cls.__name__, filepath))
+        (magic, version, build, release,
+         count, alleles_size) = INDEX_FILE_HEADER.unpack_from(data)
+        if magic != cls.file_magic or version != INDEX_FILE_VERSION:
+            raise ValueError('Unrecognized {} file: {}'.format(
+                cls.__name__, filepath))
+        keys_start = INDEX_FILE_HEADER.size
+        offsets_start = keys_start + 8 * count
+        alleles_start = offsets_start + 8 * (count + 1)
+        if len(data) != alleles_start + alleles_size:
+            raise ValueError('Truncated {} file: {}'.format(
+                cls.__name__, filepath))
+        view = memoryview(data)
+        return cls(
+            keys=view[keys_start:offsets_start].cast('Q'),
+            allele_offsets=view[offsets_start:alleles_start].cast('Q'),
+            alleles=view[alleles_start:],
+            build=build.rstrip(b'\x00').decode(),
+            release=release.rstrip(b'\x00').decode(),
+            filepath=filepath)
+
+    def chromosome_range(self, first_chrom, last_chrom):
+        """
+        Return an index restricted to chromosomes first_chrom to last_chrom.
+
+        The returned index shares this index's arrays (for an mmapped index,
+        no data is copied). It isn't backed by a file of its own.
+        """
+        lo = bisect_left(self.keys, position_key(first_chrom, 0))
+        hi = bisect_left(self.keys, position_key(last_chrom + 1, 0), lo)
+        return self.__class__(
+            keys=self.keys[lo:hi],
+            allele_offsets=self.allele_offsets[lo:hi + 1],
+            alleles=self.alleles,
+            build=self.build,
+            release=self.release)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        """
+        Iterate over (chrom, pos, ref_allele, var_allele) tuples.
+        """
+        for i, key in enumerate(self.keys):
+            yield (key >> 32, key & 0xFFFFFFFF) + tuple(
+                value.decode() for value in self._allele_pair(i).split(b'\t'))
+
+    def _allele_pair(self, i):
+        return bytes(
+            self.alleles[self.allele_offsets[i]:self.allele_offsets[i + 1]])
+
+    def has_position(self, chrom, pos):
+        """
+        True if any indexed variant starts at this position.
+        """
+        key = position_key(chrom, pos)
+        i = bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def contains(self, chrom, pos, ref_allele, var_allele):
+        """
+        True if this exact variant is in the index.
+        """
+        key = position_key(chrom, pos)
+        lo = bisect_left(self.keys, key)
+        hi = bisect_right(self.keys, key, lo)
+        if lo == hi:
+            return False
+        allele_pair = '{}\t{}'.format(ref_allele, var_allele).encode()
+        return any(self._allele_pair(i) == allele_pair for i in range(lo, hi))
@@ -0,0 +1,179 @@
+"""Matching genome files against ClinVar in the database (PostgreSQL)"""
+import io
+
+from django.db import connection, transaction
+from django.utils import timezone as django_timezone
+
+from .models import (CLINVAR_TABLE_LOCK_ID, ClinVarSigVariant,
+                     GenomeReport, GenomeVariant, Variant)
+
+# Temporary table holding a genome's calls, see match_genome_report.
+CALLS_TABLE = 'genevieve_genome_calls'
+
+# Temporary table holding the calls matching ClinVar.
+HITS_TABLE = 'genevieve_genome_hits'
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n')
+
+
+class CopyRows(io.RawIOBase):
+    """
+    Tuples encoded as a file of COPY text-format data, read as needed.
+
+    Pass to a cursor's copy_expert to stream rows without holding them all.
+    """
+    def __init__(self, rows):
+        self.lines = ('\t'.join(_copy_value(v) for v in row).encode() + b'\n'
+                      for row in rows)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = [self.pending]
+        size = len(self.pending)
+        if size < len(b):
+            for line in self.lines:
+                data.append(line)
+                size += len(line)
+                if size >= len(b):
+                    break
+        data = b''.join(data)
+        size = min(len(b), len(data))
+        b[:size] = data[:size]
+        self.pending = data[size:]
+        return size
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    Load an iterable of tuples into a table's columns with COPY.
+    """
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+        table, ', '.join(columns)), CopyRows(rows), size=64 * 1024)
+
+
+def load_clinvar_table(clinvar_sig):
+    """
+    Load a ClinVarIndex into the ClinVarSigVariant table, once per release.
+
+    Concurrent loads of a release wait for the first and then skip it. Rows
+    for releases before the previous one are deleted, as reports being
+    matched may still use the previous release.
+    """
+    release = clinvar_sig.release
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                       [CLINVAR_TABLE_LOCK_ID])
+        if ClinVarSigVariant.objects.filter(release=release).exists():
+            return
+        print("Loading ClinVar release {} into the database...".format(
+            release))
+        copy_rows(cursor, ClinVarSigVariant._meta.db_table,
+                  ['release', 'chromosome', 'pos', 'ref_allele',
+                   'var_allele'],
+                  ((release,) + variant for variant in clinvar_sig))
+        previous_release = ClinVarSigVariant.objects.filter(
+            release__lt=release).order_by('-release').values_list(
+            'release', flat=True).first()
+        if previous_release:
+            ClinVarSigVariant.objects.filter(
+                release__lt=previous_release).delete()
+        cursor.execute('ANALYZE {}'.format(ClinVarSigVariant._meta.db_table))
+
+
+def match_genome_report(genome_report, calls, clinvar_release):
+    """
+    Update a GenomeReport's variants to its calls matching a ClinVar release.
+
+    calls are (chrom, pos, ref_allele, var_allele, zygosity) tuples, which
+    are copied into a temporary table (never written to the WAL). Variants
+    and GenomeVariants are then created by joining it with the
+    ClinVarSigVariant table, in a few set-based statements. As in
+    tasks.complete_genome_report, the report's rows are only changed in one
+    short transaction at the end, which also marks it processed.
+
+    Returns the hits, and the numbers of GenomeVariants added and deleted.
+    """
+    variant_table = Variant._meta.db_table
+    genome_variant_table = GenomeVariant._meta.db_table
+    with connection.cursor() as cursor:
+        # Temporary tables last for the connection, which workers reuse.
+        cursor.execute('DROP TABLE IF EXISTS {}, {}'.format(
+            CALLS_TABLE, HITS_TABLE))
+        cursor.execute(
+            'CREATE TEMPORARY TABLE {} (chromosome smallint, pos integer, '
+            'ref_allele text, var_allele text, zygosity varchar(3))'.format(
+                CALLS_TABLE))
+        try:
+            copy_rows(cursor, CALLS_TABLE, ['chromosome', 'pos', 'ref_allele',
+                                            'var_allele', 'zygosity'], calls)
+            cursor.execute('ANALYZE {}'.format(CALLS_TABLE))
+            cursor.execute(
+                'CREATE TEMPORARY TABLE {hits} AS '
+                'SELECT DISTINCT c.chromosome, c.pos, c.ref_allele, '
+                'c.var_allele, c.zygosity FROM {calls} c '
+                'JOIN {clinvar} s ON s.release = %s AND '
+                's.chromosome = c.chromosome AND s.pos = c.pos AND '
+                's.ref_allele = c.ref_allele AND '
+                's.var_allele = c.var_allele'.format(
+                    hits=HITS_TABLE, calls=CALLS_TABLE,
+                    clinvar=ClinVarSigVariant._meta.db_table),
+                [clinvar_release])
+            cursor.execute(
+                'INSERT INTO {variant} (chromosome, pos, ref_allele, '
+                'var_allele, myvariant_clinvar, myvariant_exac, '
+                'myvariant_dbsnp, myvariant_gnomad_genome) '
+                'SELECT DISTINCT chromosome, pos, ref_allele, var_allele, '
+                "'{{}}'::jsonb, '{{}}'::jsonb, '{{}}'::jsonb, '{{}}'::jsonb "
+                'FROM {hits} '
+                'ON CONFLICT (chromosome, pos, ref_allele, var_allele) '
+                'DO NOTHING'.format(variant=variant_table, hits=HITS_TABLE))
+
+            with transaction.atomic():
+                # Serialize concurrent updates of the same report.
+                GenomeReport.objects.select_for_update().filter(
+                    id=genome_report.id).exists()
+                cursor.execute(
+                    'DELETE FROM {genome_variant} gv '
+                    'WHERE gv.genome_id = %s AND NOT EXISTS ('
+                    'SELECT 1 FROM {hits} h JOIN {variant} v ON '
+                    'v.chromosome = h.chromosome AND v.pos = h.pos AND '
+                    'v.ref_allele = h.ref_allele AND '
+                    'v.var_allele = h.var_allele '
+                    'WHERE v.id = gv.variant_id AND '
+                    'h.zygosity = gv.zygosity)'.format(
+                        genome_variant=genome_variant_table,
+                        hits=HITS_TABLE, variant=variant_table),
+                    [genome_report.id])
+                deleted = cursor.rowcount
+                cursor.execute(
+                    'INSERT INTO {genome_variant} (genome_id, variant_id, '
+                    'zygosity) SELECT %s, v.id, h.zygosity FROM {hits} h '
+                    'JOIN {variant} v ON v.chromosome = h.chromosome AND '
+                    'v.pos = h.pos AND v.ref_allele = h.ref_allele AND '
+                    'v.var_allele = h.var_allele '
+                    'ON CONFLICT (genome_id, variant_id, zygosity) '
+                    'DO NOTHING'.format(
+                        genome_variant=genome_variant_table,
+                        hits=HITS_TABLE, variant=variant_table),
+                    [genome_report.id])
+                added = cursor.rowcount
+                genome_report.last_processed = django_timezone.now()
+                genome_report.clinvar_release = clinvar_release
+                genome_report.save(
+                    update_fields=['last_processed', 'clinvar_release'])
+
+            cursor.execute('SELECT chromosome, pos, ref_allele, var_allele, '
+                           'zygosity FROM {}'.format(HITS_TABLE))
+            hits = cursor.fetchall()
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS {}, {}'.format(
+                CALLS_TABLE, HITS_TABLE))
+    return hits, added, deleted
@@ -1,6 +1,7 @@
 from django import forms
 
 from .models import GenomeReport
+from .tasks import genome_file_samples
 
 GENEVIEVE_EFFECT_CHOICES = (
     ('causal', 'Causes this trait or disease'),
@@ -26,6 +27,46 @@ class GenomeUploadForm(forms.ModelForm):
     """
     Genome file upload form.
     """
+    vcf_samples = forms.CharField(
+        required=False,
+        label='Samples',
+        help_text='For multi-sample VCF files, comma-separated names of the '
+                  'samples to report on. Leave blank to report on the first '
+                  'sample.')
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop('user')
+        super(GenomeUploadForm, self).__init__(*args, **kwargs)
+
+    def clean_vcf_samples(self):
+        vcf_samples = [sample.strip() for sample in
+                       self.cleaned_data['vcf_samples'].split(',') if
+                       sample.strip()]
+        if len(set(vcf_samples)) < len(vcf_samples):
+            raise forms.ValidationError('List each sample only once.')
+        return vcf_samples
+
+    def clean(self):
+        cleaned_data = super(GenomeUploadForm, self).clean()
+        # Checked before the genome file is read for its sample names.
+        if not self.user.genevieveuser.genome_upload_enabled:
+            raise forms.ValidationError(
+                'Account not authorized to upload genomes.')
+        vcf_samples = cleaned_data.get('vcf_samples')
+        if vcf_samples and cleaned_data.get('genome_file_url'):
+            try:
+                file_samples = genome_file_samples(
+                    cleaned_data['genome_file_url'])
+            except Exception:
+                self.add_error('genome_file_url', 'Unable to read the '
+                               'sample names in this genome file.')
+                return cleaned_data
+            missing = [s for s in vcf_samples if s not in file_samples]
+            if missing:
+                self.add_error('vcf_samples', 'Not in this genome file: '
+                               '{}'.format(', '.join(missing)))
+        return cleaned_data
+
     class Meta:
         model = GenomeReport
         fields = ['report_name', 'genome_file_url']
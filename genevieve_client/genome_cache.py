@@ -0,0 +1,225 @@
+"""Local cache of genome files, addressed by content hash"""
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+
+import requests
+
+# Cache directory layout: files/<sha256>/<filename> holds each distinct file
+# (with anything derived from it, such as an indexed copy), refs/<key> holds
+# the files/ path for a source key, and tmp/ holds downloads in progress.
+
+
+class IncompleteDownloadError(IOError):
+    pass
+
+
+# Errors after which a download is resumed, rather than given up on.
+RESUMABLE_DOWNLOAD_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    IncompleteDownloadError,
+)
+
+
+def response_filename(req):
+    """
+    Return the original filename for a file download response.
+    """
+    orig_filename = ''
+    if 'Content-Disposition' in req.headers:
+        regex = re.match(r'attachment; filename="(.*)"$',
+                         req.headers['Content-Disposition'])
+        if regex:
+            orig_filename = regex.groups()[0]
+    if not orig_filename:
+        orig_filename = urlparse.urlsplit(req.url)[2].split('/')[-1]
+    return orig_filename
+
+
+def source_key(*parts):
+    """
+    Return the cache key for a file, given strings identifying its source.
+    """
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _makedirs(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Created by another process in the meantime.
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def tmp_dir(cache_dir):
+    """
+    Return the cache's directory for files being written, creating it.
+    """
+    return _makedirs(os.path.join(cache_dir, 'tmp'))
+
+
+def lookup(cache_dir, key):
+    """
+    Return the path of the cached file for a source key, or None.
+
+    A hit marks the file as recently used.
+    """
+    try:
+        with open(os.path.join(cache_dir, 'refs', key)) as f:
+            relpath = f.read().strip()
+    except IOError:
+        return None
+    filepath = os.path.join(cache_dir, 'files', relpath)
+    if not os.path.exists(filepath):
+        return None
+    os.utime(os.path.dirname(filepath), None)
+    return filepath
+
+
+def content_hash(cached_filepath):
+    """
+    Return the SHA-256 hash (hex) of a file's content, given its cache path.
+    """
+    return os.path.basename(os.path.dirname(cached_filepath))
+
+
+def add_file(cache_dir, key, filepath, filename, max_size):
+    """
+    Move a complete file into the cache for a source key. Return its path.
+
+    The file is stored under its SHA-256 hash, so sources with the same
+    content share one copy. Least recently used files are then evicted to
+    keep the cache within max_size bytes.
+    """
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    relpath = os.path.join(sha256.hexdigest(), filename)
+    cached_filepath = os.path.join(cache_dir, 'files', relpath)
+    _makedirs(os.path.dirname(cached_filepath))
+    if os.path.exists(cached_filepath):
+        os.remove(filepath)
+    else:
+        os.rename(filepath, cached_filepath)
+
+    refs_dir = _makedirs(os.path.join(cache_dir, 'refs'))
+    tmp_ref_path = os.path.join(tmp_dir(cache_dir),
+                                '{}.ref{}'.format(key, os.getpid()))
+    with open(tmp_ref_path, 'w') as f:
+        f.write(relpath)
+    os.rename(tmp_ref_path, os.path.join(refs_dir, key))
+
+    os.utime(os.path.dirname(cached_filepath), None)
+    evict(cache_dir, max_size, keep=os.path.dirname(cached_filepath))
+    return cached_filepath
+
+
+def evict(cache_dir, max_size, keep=None):
+    """
+    Remove least recently used files until the cache is within max_size.
+
+    The keep directory (of a file just added) is never removed. References
+    to removed files are left, and are treated as misses by lookup.
+    """
+    files_dir = os.path.join(cache_dir, 'files')
+    if not os.path.isdir(files_dir):
+        return
+    entries = []
+    for name in os.listdir(files_dir):
+        entry_dir = os.path.join(files_dir, name)
+        try:
+            size = sum(os.path.getsize(os.path.join(entry_dir, f)) for
+                       f in os.listdir(entry_dir))
+            entries.append((os.stat(entry_dir).st_mtime, entry_dir, size))
+        except OSError:
+            # Evicted by another process in the meantime.
+            continue
+    total_size = sum(entry[2] for entry in entries)
+    for _, entry_dir, size in sorted(entries):
+        if total_size <= max_size:
+            break
+        if entry_dir == keep:
+            continue
+        print("Evicting cached genome file: {}".format(entry_dir))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def _download_part(url, part_path, chunk_size):
+    """
+    Download to part_path, resuming from any data already there.
+
+    Returns the file's original name.
+    """
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    req = requests.get(url, headers=headers, stream=True)
+    try:
+        if offset and req.status_code == 416:
+            # Nothing left to resume, so the partial file can't be trusted.
+            os.remove(part_path)
+            return _download_part(url, part_path, chunk_size)
+        elif offset and req.status_code == 206:
+            mode = 'ab'
+        elif req.status_code == 200:
+            mode = 'wb'
+        else:
+            raise Exception('File URL not working! Data processing aborted: '
+                            '{}'.format(url))
+        written = 0
+        with open(part_path, mode) as f:
+            for chunk in req.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+        # Lengths only compare if requests didn't decode the content.
+        if ('Content-Length' in req.headers and
+                'Content-Encoding' not in req.headers and
+                written != int(req.headers['Content-Length'])):
+            raise IncompleteDownloadError(
+                'Download ended after {} of {} bytes: {}'.format(
+                    written, req.headers['Content-Length'], url))
+        return response_filename(req)
+    finally:
+        req.close()
+
+
+def download(cache_dir, key, url, max_size, retries=3,
+             chunk_size=512 * 1024):
+    """
+    Download a file into the cache for a source key. Return its path.
+
+    The file is downloaded to a partial file named for the key, and resumed
+    with HTTP Range requests if the transfer is interrupted (by an error, up
+    to retries times, or by a restart if the disk survives). Only one
+    process downloads a key at a time; others wait for it, then use its
+    file.
+    """
+    part_path = os.path.join(tmp_dir(cache_dir), key + '.part')
+    with open(os.path.join(tmp_dir(cache_dir), key + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        filepath = lookup(cache_dir, key)
+        if filepath:
+            return filepath
+        for attempt in range(retries + 1):
+            try:
+                filename = _download_part(url, part_path, chunk_size)
+                break
+            except RESUMABLE_DOWNLOAD_ERRORS as e:
+                if attempt == retries:
+                    raise
+                print("Resuming interrupted download ({}): {}".format(e, url))
+        return add_file(cache_dir, key, part_path, filename, max_size)
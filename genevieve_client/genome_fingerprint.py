@@ -0,0 +1,94 @@
+"""Compact record of a genome's variant calls, for rematching with ClinVar"""
+from array import array
+
+import numpy as np
+
+from .clinvar_index import ClinVarIndex, position_key
+
+
+class GenotypeFingerprint(ClinVarIndex):
+    """
+    Sorted, array-backed set of a genome's ALT allele calls.
+
+    Entries are (chrom, pos, ref_allele, var_allele, zygosity) tuples, as
+    collected by genome_scan.scan_genome_calls, stored and memory-mapped
+    like a ClinVarIndex. Matching them against a new ClinVar index only
+    needs this file, not the genome file it came from.
+    """
+    file_magic = b'GVGTFP\x00\x00'
+
+    @classmethod
+    def from_calls(cls, calls):
+        """
+        Build a fingerprint from (chrom, pos, ref, alt, zygosity) tuples.
+        """
+        builder = GenotypeFingerprintBuilder()
+        for call in calls:
+            builder.append(call)
+        return builder.build()
+
+    def matches(self, clinvar_sig):
+        """
+        Yield calls that are variants in a ClinVarIndex, as scan hits.
+        """
+        keys = np.frombuffer(self.keys, dtype=np.uint64)
+        clinvar_keys = np.frombuffer(clinvar_sig.keys, dtype=np.uint64)
+        for i in np.flatnonzero(np.isin(keys, clinvar_keys)):
+            key = int(keys[i])
+            ref, alt, zygosity = self._allele_pair(i).decode().split('\t')
+            chrom, pos = key >> 32, key & 0xFFFFFFFF
+            if clinvar_sig.contains(chrom, pos, ref, alt):
+                yield (chrom, pos, ref, alt, zygosity or None)
+
+
+class GenotypeFingerprintBuilder(object):
+    """
+    Calls collected for a GenotypeFingerprint, packed as they're appended.
+
+    Each call is added to typed arrays of keys and allele offsets and a
+    bytes table, rather than kept as a tuple, so a whole genome's calls fit
+    in a few tens of bytes each. They're sorted once, by build.
+    """
+    def __init__(self):
+        self.keys = array('Q')
+        self.allele_offsets = array('Q', [0])
+        self.alleles = bytearray()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, call):
+        """
+        Add a (chrom, pos, ref, alt, zygosity) call.
+        """
+        chrom, pos, ref, alt, zygosity = call
+        self.keys.append(position_key(chrom, pos))
+        # Zygosity is None for genotypes of more than two alleles.
+        self.alleles += '{}\t{}\t{}'.format(ref, alt, zygosity or '').encode()
+        self.allele_offsets.append(len(self.alleles))
+
+    def build(self):
+        """
+        Return the calls as a GenotypeFingerprint, sorted and deduplicated.
+        """
+        keys = array('Q')
+        allele_offsets = array('Q', [0])
+        alleles = bytearray()
+
+        def add(key, allele_pairs):
+            for allele_pair in sorted(allele_pairs):
+                keys.append(key)
+                alleles.extend(allele_pair)
+                allele_offsets.append(len(alleles))
+
+        last_key, key_allele_pairs = None, set()
+        for i in np.argsort(np.frombuffer(self.keys, dtype=np.uint64),
+                            kind='stable'):
+            key = self.keys[i]
+            if key != last_key:
+                add(last_key, key_allele_pairs)
+                last_key, key_allele_pairs = key, set()
+            key_allele_pairs.add(bytes(self.alleles[
+                self.allele_offsets[i]:self.allele_offsets[i + 1]]))
+        add(last_key, key_allele_pairs)
+        return GenotypeFingerprint(keys, allele_offsets, bytes(alleles))
@@ -0,0 +1,522 @@
+"""Scanning genome VCF files for ClinVar 'significant variants'"""
+from collections import Counter, deque
+import io
+import re
+
+import billiard
+import numpy as np
+from vcf2clinvar.common import CHROM_INDEX
+from vcf2clinvar.genome import GenomeVCFLine
+
+from .clinvar_index import ClinVarIndex
+
+# VCF contig names mapped to chromosome indexes (as used by Variant).
+# Contigs not listed here (decoys, unplaced scaffolds) are skipped.
+CONTIG_INDEX = {k.encode(): v for k, v in CHROM_INDEX.items()}
+
+
+def get_zyg(genome_vcf_line):
+    genotype_allele_indexes = genome_vcf_line.genotype_allele_indexes
+    genome_alleles = [genome_vcf_line.alleles[x] for
+                      x in genotype_allele_indexes]
+    if len(genome_alleles) == 1:
+        return 'Hem'
+    elif len(genome_alleles) == 2:
+        if genome_alleles[0].sequence == genome_alleles[1].sequence:
+            return 'Hom'
+            genome_alleles = [genome_alleles[0]]
+        else:
+            return 'Het'
+
+
+def line_hits(line, chrom, pos, clinvar_sig):
+    """
+    Return ClinVar hits for a genome VCF line (bytes) at a ClinVar position.
+
+    Hits are (chrom, pos, ref_allele, var_allele, zygosity) tuples, one for
+    each allele in the genotype that matches a ClinVar significant variant.
+    """
+    vcf_line = line.decode('utf-8')
+    entries = vcf_line.rstrip().split('\t')
+    ref_allele = entries[3]
+    alleles = [ref_allele] + entries[4].split(',')
+    format_keys = entries[8].split(':')
+    if 'GT' not in format_keys:
+        return []
+    genotypes = set(re.split(
+        '[|/]', entries[9].split(':')[format_keys.index('GT')]))
+    genome_vcf_line = None
+    hits = []
+    for genotype in genotypes:
+        try:
+            var_allele = alleles[int(genotype)]
+        except ValueError:
+            continue
+        if not clinvar_sig.contains(chrom, pos, ref_allele, var_allele):
+            continue
+        if not genome_vcf_line:
+            genome_vcf_line = GenomeVCFLine(vcf_line=vcf_line, skip_info=True)
+        hits.append((chrom, pos, ref_allele, var_allele,
+                     get_zyg(genome_vcf_line)))
+    return hits
+
+
+def scan_genome(genome_in, clinvar_sig, stats=None):
+    """
+    Yield ClinVar hits from a genome VCF file opened in binary mode.
+
+    Only CHROM and POS are parsed for each line. The rest of the line is only
+    parsed if that position is in the ClinVar index, which is rare. If stats
+    is a Counter, the number of records read and examined is added to it.
+    """
+    records = examined = 0
+    for line in genome_in:
+        if line.startswith(b'#'):
+            continue
+        records += 1
+        fields = line.split(b'\t', 2)
+        chrom = CONTIG_INDEX.get(fields[0])
+        if not chrom:
+            continue
+        pos = int(fields[1])
+        if not clinvar_sig.has_position(chrom, pos):
+            continue
+        examined += 1
+        for hit in line_hits(line, chrom, pos, clinvar_sig):
+            yield hit
+    if stats is not None:
+        stats.update(records=records, examined=examined)
+
+
+# ALT values of gVCF reference blocks (and of sites with no variant allele).
+GVCF_REFERENCE_ALTS = {b'<NON_REF>', b'<*>', b'.'}
+
+# Genotypes without any ALT allele, by the stats key they're counted under.
+GVCF_SKIPPED_GENOTYPES = dict(
+    [(gt, 'hom_ref') for gt in (b'0', b'0/0', b'0|0', b'0/.', b'./0',
+                                b'0|.', b'.|0')] +
+    [(gt, 'no_call') for gt in (b'.', b'./.', b'.|.')])
+
+
+def gvcf_skip_reason(fields, column=9):
+    """
+    Return why a record (split on tabs) has no ALT allele call, or None.
+
+    The reason is the stats key skipped records are counted under. Only the
+    ALT column and the GT value in the given sample column are looked at.
+    """
+    if len(fields) <= column:
+        return None
+    if fields[4] in GVCF_REFERENCE_ALTS:
+        return 'reference_blocks'
+    # GT is always the first FORMAT key, if present.
+    if fields[8].startswith(b'GT'):
+        return GVCF_SKIPPED_GENOTYPES.get(
+            fields[column].partition(b':')[0].rstrip())
+    return None
+
+
+def scan_gvcf(genome_in, clinvar_sig, stats=None):
+    """
+    Yield ClinVar hits from a gVCF file opened in binary mode.
+
+    Most gVCF records are reference blocks, hom-ref or no-call genotypes.
+    These are spotted from their ALT and GT bytes and skipped before CHROM
+    and POS are parsed. Other records are scanned as in scan_genome. If stats
+    is a Counter, the number of records read, skipped (as 'reference_blocks',
+    'hom_ref' or 'no_call') and examined is added to it.
+    """
+    records = examined = 0
+    skipped = Counter()
+    for line in genome_in:
+        if line.startswith(b'#'):
+            continue
+        records += 1
+        fields = line.split(b'\t', 10)
+        skip_reason = gvcf_skip_reason(fields)
+        if skip_reason:
+            skipped[skip_reason] += 1
+            continue
+        chrom = CONTIG_INDEX.get(fields[0])
+        if not chrom:
+            continue
+        pos = int(fields[1])
+        if not clinvar_sig.has_position(chrom, pos):
+            continue
+        examined += 1
+        for hit in line_hits(line, chrom, pos, clinvar_sig):
+            yield hit
+    if stats is not None:
+        stats.update(skipped, records=records, examined=examined)
+
+
+def vcf_sample_names(genome_in, max_size=-1):
+    """
+    Return the sample names in a genome VCF file's '#CHROM' header line.
+
+    At most max_size bytes are read, if given. Raises ValueError if the
+    header has no such line within them.
+    """
+    size = 0
+    while max_size < 0 or size < max_size:
+        line = genome_in.readline(max_size - size if max_size >= 0 else -1)
+        size += len(line)
+        if line.startswith(b'#CHROM') and (
+                line.endswith(b'\n') or size < max_size or max_size < 0):
+            return line.decode('utf-8').rstrip().split('\t')[9:]
+        if not line.startswith(b'#'):
+            break
+    raise ValueError('Genome VCF has no #CHROM header line.')
+
+
+def sample_columns(header_line, sample_names):
+    """
+    Return the column index of each named sample, from a '#CHROM' line.
+
+    A blank name refers to the first sample. Raises ValueError if a sample
+    isn't in the header.
+    """
+    columns = header_line.decode('utf-8').rstrip().split('\t')
+    sample_indexes = []
+    for name in sample_names:
+        if not name:
+            sample_indexes.append(9)
+            continue
+        try:
+            sample_indexes.append(columns.index(name, 9))
+        except ValueError:
+            raise ValueError('Sample not in genome VCF header: ' + name)
+    return sample_indexes
+
+
+def line_sample_calls(line, chrom, pos, columns):
+    """
+    Return the alleles called for several samples in a genome VCF line.
+
+    Calls are (column, (chrom, pos, ref_allele, var_allele, zygosity))
+    tuples, one for each distinct allele in each sample column's genotype.
+    The line is only split once for all samples.
+    """
+    entries = line.decode('utf-8').rstrip().split('\t')
+    ref_allele = entries[3]
+    alleles = [ref_allele] + entries[4].split(',')
+    format_keys = entries[8].split(':')
+    if 'GT' not in format_keys:
+        return []
+    gt_index = format_keys.index('GT')
+    calls = []
+    for column in columns:
+        sample_data = entries[column].split(':')
+        genotype = [alleles[int(x)] for x in
+                    re.split('[|/]', sample_data[gt_index]) if x != '.']
+        # Zygosity as given by get_zyg.
+        zygosity = None
+        if len(genotype) == 1:
+            zygosity = 'Hem'
+        elif len(genotype) == 2:
+            zygosity = 'Hom' if genotype[0] == genotype[1] else 'Het'
+        for var_allele in set(genotype):
+            calls.append((column, (chrom, pos, ref_allele, var_allele,
+                                   zygosity)))
+    return calls
+
+
+def line_sample_hits(line, chrom, pos, clinvar_sig, columns):
+    """
+    Return ClinVar hits for several samples in a genome VCF line (bytes).
+
+    Hits are as for line_hits, returned as (column, hit) pairs for the given
+    sample columns.
+    """
+    return [(column, call) for column, call in
+            line_sample_calls(line, chrom, pos, columns) if
+            clinvar_sig.contains(*call[:4])]
+
+
+def scan_genome_samples(genome_in, clinvar_sig, sample_names, stats=None):
+    """
+    Yield (sample_name, hit) pairs from a multi-sample genome VCF file.
+
+    The file is read once, as in scan_genome, checking the genotype of each
+    named sample at ClinVar positions. A blank name refers to the first
+    sample. Raises ValueError if a sample isn't in the file's header.
+    """
+    names_by_column = None
+    if not any(sample_names):
+        names_by_column = {9: list(sample_names)}
+    records = examined = 0
+    for line in genome_in:
+        if line.startswith(b'#'):
+            if line.startswith(b'#CHROM'):
+                names_by_column = dict()
+                for name, column in zip(
+                        sample_names, sample_columns(line, sample_names)):
+                    names_by_column.setdefault(column, []).append(name)
+            continue
+        if names_by_column is None:
+            raise ValueError('Genome VCF has no #CHROM header line.')
+        records += 1
+        fields = line.split(b'\t', 2)
+        chrom = CONTIG_INDEX.get(fields[0])
+        if not chrom:
+            continue
+        pos = int(fields[1])
+        if not clinvar_sig.has_position(chrom, pos):
+            continue
+        examined += 1
+        for column, hit in line_sample_hits(line, chrom, pos, clinvar_sig,
+                                            names_by_column):
+            for name in names_by_column[column]:
+                yield name, hit
+    if stats is not None:
+        stats.update(records=records, examined=examined)
+
+
+def genome_calls(genome_in, sample_name='', stats=None):
+    """
+    Yield the ALT allele calls in a genome VCF file.
+
+    Every record's genotype (for sample_name, or the first sample) is
+    parsed, skipping records without ALT allele calls as in scan_gvcf. Each
+    ALT allele called is yielded as a (chrom, pos, ref_allele, var_allele,
+    zygosity) tuple.
+    """
+    column = 9
+    records = examined = 0
+    skipped = Counter()
+    for line in genome_in:
+        if line.startswith(b'#'):
+            if sample_name and line.startswith(b'#CHROM'):
+                column = sample_columns(line, [sample_name])[0]
+            continue
+        records += 1
+        fields = line.split(b'\t', column + 1)
+        skip_reason = gvcf_skip_reason(fields, column)
+        if skip_reason:
+            skipped[skip_reason] += 1
+            continue
+        chrom = CONTIG_INDEX.get(fields[0])
+        if not chrom:
+            continue
+        examined += 1
+        for _, call in line_sample_calls(line, chrom, int(fields[1]),
+                                         [column]):
+            if call[2] != call[3]:
+                yield call
+    if stats is not None:
+        stats.update(skipped, records=records, examined=examined)
+
+
+def scan_genome_calls(genome_in, clinvar_sig, calls, sample_name='',
+                      stats=None):
+    """
+    Yield ClinVar hits from a genome VCF file, collecting all its ALT calls.
+
+    Calls are read as by genome_calls, and each is appended to calls (a
+    list, or a GenotypeFingerprintBuilder to keep them compactly). Hits
+    are the calls that are ClinVar significant variants, so a hom-ref call
+    never matches a ClinVar record without an ALT allele here.
+    """
+    for call in genome_calls(genome_in, sample_name, stats):
+        calls.append(call)
+        if clinvar_sig.contains(*call[:4]):
+            yield call
+
+
+def _pack_contig(name):
+    return int.from_bytes(name.ljust(8, b'\x00'), 'big')
+
+
+def scan_genome_numpy(genome_in, clinvar_sig, stats=None,
+                      block_size=16 * 1024 * 1024):
+    """
+    Yield ClinVar hits from a genome VCF file, matching positions in blocks.
+
+    The file is read in large blocks of whole lines. CHROM and POS for every
+    line in a block are extracted into NumPy arrays and checked against the
+    ClinVar index with a vectorized binary search. Only lines at ClinVar
+    positions are parsed further, as in scan_genome, so hits (and stats) are
+    identical.
+    """
+    contigs = sorted((_pack_contig(k), v) for k, v in CONTIG_INDEX.items())
+    contig_codes = np.array([c[0] for c in contigs], dtype=np.uint64)
+    contig_chroms = np.array([c[1] for c in contigs], dtype=np.uint64)
+    clinvar_keys = np.frombuffer(clinvar_sig.keys, dtype=np.uint64)
+    if not len(clinvar_keys):
+        return
+
+    records = examined = 0
+    carry = b''
+    while True:
+        block = genome_in.read(block_size)
+        data = carry + block
+        if block:
+            # Keep any partial last line for the next block.
+            last_newline = data.rfind(b'\n')
+            if last_newline < 0:
+                carry = data
+                continue
+            data, carry = data[:last_newline + 1], data[last_newline + 1:]
+        elif not data:
+            break
+        else:
+            # Last line, without a newline: scan it in a final pass.
+            data, carry = data + b'\n', b''
+
+        buf = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(buf == ord('\n'))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        tabs = np.append(np.flatnonzero(buf == ord('\t')), len(buf))
+        tab1_idx = np.searchsorted(tabs, starts)
+        tab1 = tabs[tab1_idx]
+        tab2 = tabs[np.minimum(tab1_idx + 1, len(tabs) - 1)]
+
+        # Header lines and lines without CHROM and POS columns.
+        not_header = buf[starts] != ord('#')
+        records += int(np.count_nonzero(not_header))
+        valid = not_header & (tab2 < ends)
+
+        # Pack CHROM names of up to 8 bytes into integers to look them up.
+        chrom_len = tab1 - starts
+        valid &= (chrom_len > 0) & (chrom_len <= 8)
+        codes = np.zeros(len(starts), dtype=np.uint64)
+        for k in range(8):
+            byte = buf[np.minimum(starts + k, len(buf) - 1)].astype(np.uint64)
+            codes |= np.where(k < chrom_len, byte, 0) << np.uint64(8 * (7 - k))
+        contig_idx = np.minimum(np.searchsorted(contig_codes, codes),
+                                len(contig_codes) - 1)
+        valid &= contig_codes[contig_idx] == codes
+        chroms = contig_chroms[contig_idx]
+
+        # Parse POS digits, up to nine (beyond any human chromosome length).
+        pos_len = tab2 - tab1 - 1
+        valid &= (pos_len > 0) & (pos_len <= 9)
+        positions = np.zeros(len(starts), dtype=np.uint64)
+        for k in range(9):
+            in_pos = k < pos_len
+            digit = buf[np.minimum(tab1 + 1 + k, len(buf) - 1)].astype(
+                np.int64) - ord('0')
+            valid &= ~in_pos | ((digit >= 0) & (digit <= 9))
+            positions = np.where(
+                in_pos, positions * np.uint64(10) +
+                np.clip(digit, 0, 9).astype(np.uint64), positions)
+
+        keys = (chroms << np.uint64(32)) | positions
+        clinvar_idx = np.minimum(np.searchsorted(clinvar_keys, keys),
+                                 len(clinvar_keys) - 1)
+        matched = np.flatnonzero(valid & (clinvar_keys[clinvar_idx] == keys))
+        examined += len(matched)
+
+        for i in matched:
+            line = data[starts[i]:ends[i] + 1]
+            for hit in line_hits(line, int(chroms[i]), int(positions[i]),
+                                 clinvar_sig):
+                yield hit
+
+    if stats is not None:
+        stats.update(records=records, examined=examined)
+
+
+# Genome scan engines, selected with the GENOME_SCAN_ENGINE setting.
+SCAN_ENGINES = {
+    'lines': scan_genome,
+    'numpy': scan_genome_numpy,
+    'gvcf': scan_gvcf,
+}
+
+
+def read_line_chunks(filebuffer, chunk_size):
+    """
+    Yield chunks of about chunk_size bytes of whole lines from a binary file.
+    """
+    chunk = b''.join(filebuffer.readlines(chunk_size))
+    while chunk:
+        yield chunk
+        chunk = b''.join(filebuffer.readlines(chunk_size))
+
+
+def map_chunks(func, chunks, processes):
+    """
+    Apply func to each chunk using a process pool, yielding results in order.
+
+    billiard's Pool is used as, unlike multiprocessing's, it can be started
+    within daemonic Celery workers. Only a few chunks per process are in
+    flight at once, so chunks aren't all read into memory ahead of use.
+    """
+    if processes <= 1:
+        for chunk in chunks:
+            yield func(chunk)
+        return
+    pool = billiard.Pool(processes)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(func, (chunk,)))
+            if len(pending) > 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# ClinVar indexes opened by scan_genome_parallel pool processes, by filepath.
+_pool_clinvar_sig = dict()
+
+
+def _scan_chunk(args):
+    engine, clinvar_sig_filepath, chunk = args
+    stats = Counter()
+    if clinvar_sig_filepath not in _pool_clinvar_sig:
+        _pool_clinvar_sig.clear()
+        _pool_clinvar_sig[clinvar_sig_filepath] = ClinVarIndex.load(
+            clinvar_sig_filepath)
+    clinvar_sig = _pool_clinvar_sig[clinvar_sig_filepath]
+    hits = list(SCAN_ENGINES[engine](io.BytesIO(chunk), clinvar_sig, stats))
+    return hits, stats
+
+
+def scan_genome_chunks(genome_in, clinvar_sig, engine, processes=1,
+                       chunk_size=8 * 1024 * 1024):
+    """
+    Yield (size, hits, stats) for each line-aligned chunk of a genome file.
+
+    Chunks of the decompressed file are scanned with the named engine, on a
+    process pool if processes > 1, and results are yielded in file order,
+    so callers can tell how far into the file scanning has got. Pool
+    processes memory-map the same ClinVar index file, so they share it
+    through the page cache.
+    """
+    sizes = deque()
+
+    def chunks():
+        for chunk in read_line_chunks(genome_in, chunk_size):
+            sizes.append(len(chunk))
+            yield (engine, clinvar_sig.filepath, chunk)
+
+    def scan_chunk(args):
+        stats = Counter()
+        hits = list(SCAN_ENGINES[engine](io.BytesIO(args[2]), clinvar_sig,
+                                         stats))
+        return hits, stats
+
+    for hits, stats in map_chunks(_scan_chunk if processes > 1 else
+                                  scan_chunk, chunks(), processes):
+        yield sizes.popleft(), hits, stats
+
+
+def scan_genome_parallel(genome_in, clinvar_sig, engine, processes,
+                         stats=None, chunk_size=8 * 1024 * 1024):
+    """
+    Yield ClinVar hits from a genome VCF file, scanning on a process pool.
+
+    The file is scanned in chunks by scan_genome_chunks. Hits are yielded in
+    file order.
+    """
+    for _, chunk_hits, chunk_stats in scan_genome_chunks(
+            genome_in, clinvar_sig, engine, processes, chunk_size):
+        if stats is not None:
+            stats.update(chunk_stats)
+        for hit in chunk_hits:
+            yield hit
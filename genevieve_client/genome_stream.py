@@ -0,0 +1,150 @@
+"""Reading genome files as they download, with an optional local copy"""
+import bz2
+import io
+import os
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def prefetch(chunks, size=16):
+    """
+    Yield items from an iterable, read ahead by a background thread.
+
+    This lets a download carry on while earlier chunks are being processed.
+    At most size items are read ahead. Errors reading items are raised when
+    the item would have been yielded.
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        try:
+            for chunk in chunks:
+                put(chunk)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put(e)
+        put(end)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _new_decompressor(filename):
+    if filename.endswith('.bz2'):
+        return bz2.BZ2Decompressor()
+    elif filename.endswith('.gz'):
+        # wbits of 31 expects a gzip header and trailer.
+        return zlib.decompressobj(31)
+    return None
+
+
+class StreamingGenomeFile(io.RawIOBase):
+    """
+    Decompressed contents of a genome file, read from an iterable of chunks.
+
+    Chunks (e.g. from requests' iter_content) are decompressed as they're
+    read, according to the filename's extension. Files made of several
+    gzip members (as in BGZF) or bz2 streams are supported.
+
+    If cache_filepath is given, chunks are also written to that path. The
+    copy is written under a temporary, hidden name and only renamed into
+    place once the whole file has been read, so a partly read file never
+    shows up in the cache. on_cached is then called with cache_filepath.
+
+    Wrap in io.BufferedReader for line iteration.
+    """
+    def __init__(self, chunks, filename, cache_filepath=None, on_close=None,
+                 on_cached=None):
+        self.chunks = iter(chunks)
+        self.filename = filename
+        self.decompressor = _new_decompressor(filename)
+        self.decompressor_used = False
+        self.pending = b''
+        self.pending_pos = 0
+        self.complete = False
+        self.on_close = on_close
+        self.on_cached = on_cached
+        self.cache_filepath = cache_filepath
+        self.cache_file = None
+        if cache_filepath:
+            cache_dir, cache_filename = os.path.split(cache_filepath)
+            self.tmp_cache_filepath = os.path.join(
+                cache_dir, '.{}.tmp{}'.format(cache_filename, os.getpid()))
+            self.cache_file = open(self.tmp_cache_filepath, 'wb')
+
+    def readable(self):
+        return True
+
+    def _decompress(self, chunk):
+        if not self.decompressor:
+            return chunk
+        data = []
+        while chunk:
+            self.decompressor_used = True
+            data.append(self.decompressor.decompress(chunk))
+            if not self.decompressor.eof:
+                break
+            # Start of the next gzip member or bz2 stream, if any.
+            chunk = self.decompressor.unused_data
+            self.decompressor = _new_decompressor(self.filename)
+            self.decompressor_used = False
+        return b''.join(data)
+
+    def readinto(self, b):
+        while self.pending_pos >= len(self.pending) and not self.complete:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                if self.decompressor_used:
+                    raise EOFError('Compressed file ended before the '
+                                   'end-of-stream marker was reached')
+                self.complete = True
+                break
+            if self.cache_file:
+                self.cache_file.write(chunk)
+            self.pending = self._decompress(chunk)
+            self.pending_pos = 0
+        size = min(len(b), len(self.pending) - self.pending_pos)
+        b[:size] = self.pending[self.pending_pos:self.pending_pos + size]
+        self.pending_pos += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            if self.on_close:
+                self.on_close()
+            if self.cache_file:
+                self.cache_file.close()
+                if self.complete:
+                    os.rename(self.tmp_cache_filepath, self.cache_filepath)
+                    if self.on_cached:
+                        self.on_cached(self.cache_filepath)
+                else:
+                    os.remove(self.tmp_cache_filepath)
+        super(StreamingGenomeFile, self).close()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def merge_duplicate_variants(apps, schema_editor):
+    """
+    Merge Variant rows sharing chromosome, position and alleles.
+
+    GenomeVariant rows pointing at a duplicate are moved to the lowest ID.
+    """
+    Variant = apps.get_model('genevieve_client', 'Variant')
+    GenomeVariant = apps.get_model('genevieve_client', 'GenomeVariant')
+    duplicated = Variant.objects.values(
+        'chromosome', 'pos', 'ref_allele', 'var_allele').annotate(
+        count=Count('id')).filter(count__gt=1)
+    for dup in duplicated:
+        del dup['count']
+        variant_ids = list(Variant.objects.filter(**dup).order_by(
+            'id').values_list('id', flat=True))
+        GenomeVariant.objects.filter(variant_id__in=variant_ids[1:]).update(
+            variant_id=variant_ids[0])
+        Variant.objects.filter(id__in=variant_ids[1:]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0011_variant_myvariant_gnomad_genome'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_variants,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='variant',
+            unique_together={('chromosome', 'pos', 'ref_allele', 'var_allele')},
+        ),
+    ]
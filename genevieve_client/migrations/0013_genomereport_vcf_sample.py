@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0012_variant_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genomereport',
+            name='vcf_sample',
+            field=models.CharField(blank=True, max_length=120),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 16:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0013_genomereport_vcf_sample'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genomereport',
+            name='clinvar_release',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 18:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0014_genomereport_clinvar_release'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenomeMatchResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('genome_sha256', models.CharField(max_length=64)),
+                ('vcf_sample', models.CharField(blank=True, max_length=120)),
+                ('clinvar_release', models.CharField(max_length=32)),
+                ('filter_version', models.CharField(max_length=16)),
+                ('hits', django.contrib.postgres.fields.jsonb.JSONField(
+                    default=list)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('genome_sha256', 'vcf_sample',
+                                     'clinvar_release', 'filter_version')},
+            },
+        ),
+    ]
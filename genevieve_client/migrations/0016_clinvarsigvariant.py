@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 20:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_genome_variants(apps, schema_editor):
+    """
+    Remove GenomeVariant rows repeating a report's variant and zygosity.
+
+    The row with the lowest ID is kept.
+    """
+    GenomeVariant = apps.get_model('genevieve_client', 'GenomeVariant')
+    duplicated = GenomeVariant.objects.values(
+        'genome', 'variant', 'zygosity').annotate(
+        count=Count('id'), min_id=Min('id')).filter(count__gt=1)
+    for dup in duplicated:
+        GenomeVariant.objects.filter(
+            genome=dup['genome'], variant=dup['variant'],
+            zygosity=dup['zygosity']).exclude(id=dup['min_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0015_genomematchresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClinVarSigVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('release', models.CharField(max_length=32)),
+                ('chromosome', models.PositiveSmallIntegerField(choices=[
+                    (1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5'),
+                    (6, '6'), (7, '7'), (8, '8'), (9, '9'), (10, '10'),
+                    (11, '11'), (12, '12'), (13, '13'), (14, '14'),
+                    (15, '15'), (16, '16'), (17, '17'), (18, '18'),
+                    (19, '19'), (20, '20'), (21, '21'), (22, '22'),
+                    (23, 'X'), (24, 'Y'), (25, 'MT')])),
+                ('pos', models.PositiveIntegerField()),
+                ('ref_allele', models.TextField()),
+                ('var_allele', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='clinvarsigvariant',
+            index=models.Index(fields=['release', 'chromosome', 'pos'],
+                               name='clinvarsig_release_pos_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_genome_variants,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='genomevariant',
+            unique_together={('genome', 'variant', 'zygosity')},
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 20:06
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0016_clinvarsigvariant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenomeReportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('scan_key', models.CharField(blank=True, max_length=40)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('hits', django.contrib.postgres.fields.jsonb.JSONField(
+                    default=list)),
+                ('stats', django.contrib.postgres.fields.jsonb.JSONField(
+                    default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('genome_report', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='genevieve_client.GenomeReport')),
+            ],
+        ),
+    ]
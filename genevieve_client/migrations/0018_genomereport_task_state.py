@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 20:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0017_genomereportcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genomereport',
+            name='lease_expires',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='genomereport',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='genomereport',
+            name='task_queued',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='genomereport',
+            name='task_reprocess',
+            field=models.BooleanField(default=False),
+        ),
+    ]
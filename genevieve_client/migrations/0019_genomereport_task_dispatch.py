@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 20:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0018_genomereport_task_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genomereport',
+            name='task_dispatched',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='genomereport',
+            name='task_in_flight',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='genomereport',
+            name='task_priority',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
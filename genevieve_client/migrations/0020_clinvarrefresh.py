@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 22:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0019_genomereport_task_dispatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClinVarRefresh',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('clinvar_release', models.CharField(max_length=32,
+                                                     unique=True)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('paused', models.BooleanField(default=False)),
+                ('last_report_id', models.IntegerField(default=0)),
+                ('reports_total', models.IntegerField(default=0)),
+                ('reports_queued', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
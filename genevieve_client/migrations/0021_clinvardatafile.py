@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 23:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('genevieve_client', '0020_clinvarrefresh'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClinVarDataFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('clinvar_release', models.CharField(max_length=32)),
+                ('filename', models.CharField(max_length=255, unique=True)),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
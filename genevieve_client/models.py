@@ -7,6 +7,7 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
+from django.core.cache import cache
 from django.db import models
 from django.utils import timezone as django_timezone
 
@@ -43,6 +44,62 @@ CHROMOSOMES = OrderedDict([
     (25, 'MT'),
     ])
 
+# Django cache key for the latest ClinVar release, see
+# latest_clinvar_release.
+CLINVAR_RELEASE_CACHE_KEY = 'genevieve_latest_clinvar_release'
+
+# PostgreSQL advisory lock keys, kept together so each is distinct. Held
+# while dispatching report tasks (see tasks.dispatch_genome_reports), while
+# making a ClinVar release's data files (see tasks.make_clinvar_data) and
+# while loading a ClinVar release into the database (see
+# db_match.load_clinvar_table).
+DISPATCH_LOCK_ID = 0x47564450
+CLINVAR_DATA_LOCK_ID = 0x47564344
+CLINVAR_TABLE_LOCK_ID = 0x47564356
+
+
+def clinvar_release_date(clinvar_filename):
+    """
+    Return when a ClinVar release file is taken to have been published.
+
+    This is the end of the day in its file name (US Eastern time), so
+    reports processed since are up to date with it.
+    """
+    cv_year, cv_month, cv_day = [int(x) for x in re.search(
+        r'_(20[0-9][0-9])([01][0-9])([0-3][0-9])\.vcf',
+        clinvar_filename).groups()]
+    try:
+        return datetime.datetime(
+            cv_year, cv_month, cv_day + 1, 0, 0, 0,
+            tzinfo=pytz_timezone('US/Eastern'))
+    except ValueError:
+        try:
+            return datetime.datetime(
+                cv_year, cv_month + 1, 1, 0, 0, 0,
+                tzinfo=pytz_timezone('US/Eastern'))
+        except ValueError:
+            return datetime.datetime(
+                cv_year + 1, 1, 1, 0, 0, 0,
+                tzinfo=pytz_timezone('US/Eastern'))
+
+
+def latest_clinvar_release(update=False):
+    """
+    Return the latest ClinVar release's file name and publication date.
+
+    Looking it up lists the ClinVar site, so the result is shared through
+    the Django cache for CLINVAR_RELEASE_CACHE_SECONDS. Pass update to look
+    it up regardless, as tasks.refresh_genome_reports does periodically to
+    keep the cache fresh.
+    """
+    release = None if update else cache.get(CLINVAR_RELEASE_CACHE_KEY)
+    if release is None:
+        clinvar_filename = clinvar_update.latest_vcf_filename('b37')
+        release = (clinvar_filename, clinvar_release_date(clinvar_filename))
+        cache.set(CLINVAR_RELEASE_CACHE_KEY, release,
+                  settings.CLINVAR_RELEASE_CACHE_SECONDS)
+    return release
+
 
 class Variant(models.Model):
     chromosome = models.PositiveSmallIntegerField(choices=CHROMOSOMES.items())
@@ -56,6 +113,9 @@ class Variant(models.Model):
     myvariant_gnomad_genome = JSONField(default=dict)
     myvariant_last_update = models.DateTimeField(null=True)
 
+    class Meta:
+        unique_together = ('chromosome', 'pos', 'ref_allele', 'var_allele')
+
     def __unicode__(self):
         return self.b37_id
 
@@ -124,6 +184,22 @@ class GenomeReport(models.Model):
     genome_file_created = models.TextField()
     last_processed = models.DateTimeField(null=True)
     report_source = models.CharField(max_length=80, blank=True)
+    # Sample reported on, for multi-sample VCF files. Blank for the first.
+    vcf_sample = models.CharField(max_length=120, blank=True)
+    # ClinVar release (file name) last matched, see produce_genome_report.
+    clinvar_release = models.CharField(max_length=32, blank=True)
+    # Processing state, see tasks.queue_genome_report: when processing was
+    # requested (cleared once its task starts), whether it should reprocess
+    # in full and at what priority, when a task was last dispatched and if
+    # it's in flight, then the task holding the report while it runs, and
+    # until when.
+    task_queued = models.DateTimeField(null=True)
+    task_reprocess = models.BooleanField(default=False)
+    task_priority = models.PositiveSmallIntegerField(default=0)
+    task_dispatched = models.DateTimeField(null=True)
+    task_in_flight = models.BooleanField(default=False)
+    lease_owner = models.CharField(max_length=64, blank=True)
+    lease_expires = models.DateTimeField(null=True)
     variants = models.ManyToManyField(Variant, through='GenomeVariant',
                                       through_fields=('genome', 'variant'))
 
@@ -166,23 +242,8 @@ class GenomeReport(models.Model):
             variant.save()
 
     def new_clinvar_available(self):
-        cv_year, cv_month, cv_day = [int(x) for x in re.search(
-            r'_(20[0-9][0-9])([01][0-9])([0-3][0-9])\.vcf',
-            clinvar_update.latest_vcf_filename('b37')).groups()]
-        try:
-            cv_latest = datetime.datetime(
-                cv_year, cv_month, cv_day + 1, 0, 0, 0,
-                tzinfo=pytz_timezone('US/Eastern'))
-        except ValueError:
-            try:
-                cv_latest = datetime.datetime(
-                    cv_year, cv_month + 1, 1, 0, 0, 0,
-                    tzinfo=pytz_timezone('US/Eastern'))
-            except ValueError:
-                cv_latest = datetime.datetime(
-                    cv_year + 1, 1, 1, 0, 0, 0,
-                    tzinfo=pytz_timezone('US/Eastern'))
-        if self.last_processed and self.last_processed > cv_latest:
+        clinvar_date = latest_clinvar_release()[1]
+        if self.last_processed and self.last_processed > clinvar_date:
             return False
         return True
 
@@ -196,10 +257,13 @@ class GenomeReport(models.Model):
                 if created != self.genome_file_created:
                     self.genome_file_created = created
                     self.last_processed = None
-                self.save()
+                # Only these, as processing state may be updated meanwhile.
+                self.save(update_fields=['genome_file_url',
+                                         'genome_file_created',
+                                         'last_processed'])
 
-    def refresh(self, oh_user_data=None, force=False):
-        if self.new_clinvar_available() or force:
+    def refresh(self, oh_user_data=None, force=False, priority=None):
+        if force or self.new_clinvar_available():
             # Refresh file URL for Open Humans data.
             if self.report_source.startswith('openhumans-'):
                 self.refresh_oh_report_file_url(user_data=oh_user_data)
@@ -208,11 +272,12 @@ class GenomeReport(models.Model):
             report = GenomeReport.objects.get(pk=self.pk)
 
             # Avoid circular import.
-            from .tasks import produce_genome_report
+            from .tasks import PRIORITY_NORMAL, queue_genome_report
 
-            # Delete old variants and create a new list.
-            report.genomevariant_set.all().delete()
-            produce_genome_report.delay(report.id)
+            # Rematch, in full if forced. Otherwise, only ClinVar changes
+            # since the report's last match are applied, where recorded.
+            queue_genome_report(report.id, reprocess=force,
+                                priority=priority or PRIORITY_NORMAL)
         else:
             from .tasks import refresh_myvariant_data
             refresh_myvariant_data.delay(self.id)
@@ -226,6 +291,121 @@ class GenomeVariant(models.Model):
                                          ('Hom', 'Homozygous'),
                                          ('Hem', 'Hemizygous')))
 
+    class Meta:
+        unique_together = ('genome', 'variant', 'zygosity')
+
+
+class GenomeMatchResult(models.Model):
+    """
+    ClinVar hits for a genome file's content, reused by reports of that file.
+
+    Hits are stored as [chrom, pos, ref_allele, var_allele, zygosity] lists.
+    filter_version identifies the filtering and matching rules used.
+    """
+    genome_sha256 = models.CharField(max_length=64)
+    vcf_sample = models.CharField(max_length=120, blank=True)
+    clinvar_release = models.CharField(max_length=32)
+    filter_version = models.CharField(max_length=16)
+    hits = JSONField(default=list)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('genome_sha256', 'vcf_sample', 'clinvar_release',
+                           'filter_version')
+
+
+class GenomeFingerprint(models.Model):
+    """
+    A genome file's genotype fingerprint, shared between workers.
+
+    key identifies the genome file version and sample, and data is the
+    fingerprint as saved by GenotypeFingerprint. Workers keep a local copy,
+    see tasks.load_genome_fingerprint.
+    """
+    key = models.CharField(max_length=40, unique=True)
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class GenomeReportCheckpoint(models.Model):
+    """
+    Progress of a genome report's scan, for resuming an interrupted task.
+
+    offset is the number of decompressed bytes of the genome file scanned,
+    with the hits and scan stats found in them. scan_key identifies the
+    genome file, ClinVar index and scan engine, see tasks.checkpointed_hits.
+    """
+    genome_report = models.OneToOneField(GenomeReport,
+                                         on_delete=models.CASCADE)
+    scan_key = models.CharField(max_length=40, blank=True)
+    offset = models.BigIntegerField(default=0)
+    hits = JSONField(default=list)
+    stats = JSONField(default=dict)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ClinVarSigVariant(models.Model):
+    """
+    A ClinVar 'significant variant', for matching genomes in the database.
+
+    Rows are loaded for each ClinVar release, see db_match.
+    """
+    release = models.CharField(max_length=32)
+    chromosome = models.PositiveSmallIntegerField(choices=CHROMOSOMES.items())
+    pos = models.PositiveIntegerField()
+    ref_allele = models.TextField()
+    var_allele = models.TextField()
+
+    class Meta:
+        indexes = [models.Index(fields=['release', 'chromosome', 'pos'],
+                                name='clinvarsig_release_pos_idx')]
+
+
+class ClinVarDataFile(models.Model):
+    """
+    A ClinVar data file generated for a release, shared between workers.
+
+    Workers' local storage isn't shared (or kept), so the index and delta
+    files made for a release are stored here too, and copied by other
+    workers rather than made again. See tasks.setup_clinvar_data.
+    """
+    clinvar_release = models.CharField(max_length=32)
+    filename = models.CharField(max_length=255, unique=True)
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.filename
+
+
+class ClinVarRefresh(models.Model):
+    """
+    Refresh of all genome reports for a ClinVar release, run in batches.
+
+    See tasks.refresh_genome_reports. Reports are queued in ID order, up to
+    last_report_id so far. Set paused to stop queueing more, and clear it to
+    resume.
+    """
+    clinvar_release = models.CharField(max_length=32, unique=True)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    paused = models.BooleanField(default=False)
+    last_report_id = models.IntegerField(default=0)
+    reports_total = models.IntegerField(default=0)
+    reports_queued = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return self.clinvar_release
+
+    def progress(self):
+        """
+        Summarize how far the refresh has got.
+        """
+        reports_done = GenomeReport.objects.filter(
+            clinvar_release=self.clinvar_release).count()
+        return '{} of {} stale reports queued, {} reports up to date'.format(
+            self.reports_queued, self.reports_total, reports_done)
+
 
 class GenevieveUser(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -411,8 +591,8 @@ class OpenHumansUser(ConnectedUser):
             new_report.save()
 
             # Avoid circular import.
-            from .tasks import produce_genome_report
-            produce_genome_report.delay(new_report.id)
+            from .tasks import PRIORITY_INTERACTIVE, queue_genome_report
+            queue_genome_report(new_report.id, priority=PRIORITY_INTERACTIVE)
             if request:
                 messages.success(request, (
                     '"{}" started processing! Please give reports up to '
@@ -181,7 +181,155 @@ OPENHUMANS_URL = os.getenv('OPENHUMANS_URL')
 # Genevieve settings
 GENEVIEVE_ADMIN_EMAIL = os.getenv('GENEVIEVE_ADMIN_EMAIL', '')
 
+# Number of ClinVar hits collected in memory before they're written to the
+# database while producing a genome report.
+GENOME_REPORT_WRITE_BATCH_SIZE = int(
+    os.getenv('GENOME_REPORT_WRITE_BATCH_SIZE', '1000'))
+
+# Processes used to preprocess a new ClinVar release (0 means one per CPU),
+# and the size in bytes of the line chunks handed to each.
+CLINVAR_PREPROCESS_PROCESSES = int(
+    os.getenv('CLINVAR_PREPROCESS_PROCESSES', '0'))
+CLINVAR_PREPROCESS_CHUNK_SIZE = int(
+    os.getenv('CLINVAR_PREPROCESS_CHUNK_SIZE', str(4 * 1024 * 1024)))
+
+# Seconds the latest ClinVar release (looked up on the ClinVar site) is
+# cached for, when checking if reports are up to date. Keep it longer than
+# GENOME_REFRESH_INTERVAL, as Celery beat then keeps it fresh.
+CLINVAR_RELEASE_CACHE_SECONDS = int(
+    os.getenv('CLINVAR_RELEASE_CACHE_SECONDS', '3600'))
+
+# Engine used to match genome files against ClinVar: 'lines' parses one line
+# at a time, 'numpy' matches positions for blocks of lines at once, 'gvcf'
+# skips gVCF reference blocks, hom-ref and no-call records up front.
+GENOME_SCAN_ENGINE = os.getenv('GENOME_SCAN_ENGINE', 'lines')
+
+# Processes used to scan a single genome file; 1 scans within the task.
+GENOME_SCAN_PROCESSES = int(os.getenv('GENOME_SCAN_PROCESSES', '1'))
+
+# Keep an indexed BGZF copy of each genome file, so rematching only reads
+# the parts of the file near ClinVar positions.
+GENOME_FILE_INDEXING = to_bool('GENOME_FILE_INDEXING', 'false')
+
+# Match genome files as they download, rather than downloading them first.
+# Streamed files are also stored locally unless GENOME_FILE_STREAMING_CACHE
+# is false (e.g. for small ephemeral disks).
+GENOME_FILE_STREAMING = to_bool('GENOME_FILE_STREAMING', 'false')
+GENOME_FILE_STREAMING_CACHE = to_bool('GENOME_FILE_STREAMING_CACHE', 'true')
+
+# Most bytes of a genome file's header read to check the sample names given
+# for a multi-sample file, when a report is requested.
+GENOME_FILE_HEADER_MAX_SIZE = int(
+    os.getenv('GENOME_FILE_HEADER_MAX_SIZE', str(10 * 1024 ** 2)))
+
+# Size budget in bytes for locally cached genome files (and their indexed
+# copies), and how often an interrupted download is resumed before failing.
+GENOME_CACHE_MAX_SIZE = int(
+    os.getenv('GENOME_CACHE_MAX_SIZE', str(10 * 1024 ** 3)))
+GENOME_CACHE_DOWNLOAD_RETRIES = int(
+    os.getenv('GENOME_CACHE_DOWNLOAD_RETRIES', '3'))
+
+# Save each report's ALT allele calls as a compact "genotype fingerprint",
+# and rematch reports from that rather than from their genome files. ClinVar
+# records without an ALT allele aren't matched in this mode. Fingerprints
+# are stored in the database, so they're shared by all workers and kept
+# across restarts (workers keep local copies in LOCAL_STORAGE_ROOT).
+GENOME_FINGERPRINTS = to_bool('GENOME_FINGERPRINTS', 'false')
+
+# Match genome files in the database: each file's ALT allele calls are
+# copied into a staging table and joined with the ClinVar release. As with
+# GENOME_FINGERPRINTS, ClinVar records without an ALT allele aren't matched.
+GENOME_MATCH_IN_DATABASE = to_bool('GENOME_MATCH_IN_DATABASE', 'false')
+
+# Genome files of at least GENOME_REPORT_SUBTASKS_MIN_FILE_SIZE bytes are
+# split by chromosome into this many Celery subtasks (requires a result
+# backend); 1 processes each report in a single task. Only used with
+# GENOME_FILE_INDEXING (and not for reports on one sample of a multi-sample
+# file), as each subtask then reads only its chromosomes from the indexed
+# copy of the file; otherwise every subtask would read the whole file.
+# Subtasks find the indexed copy in LOCAL_STORAGE_ROOT, so it should be
+# shared by the 'parse' workers.
+GENOME_REPORT_SUBTASKS = int(os.getenv('GENOME_REPORT_SUBTASKS', '1'))
+GENOME_REPORT_SUBTASKS_MIN_FILE_SIZE = int(
+    os.getenv('GENOME_REPORT_SUBTASKS_MIN_FILE_SIZE',
+              str(200 * 1024 * 1024)))
+
+# Seconds between saved checkpoints while scanning a genome file, so a
+# report task that's interrupted resumes from its last checkpoint when
+# redelivered; 0 disables checkpoints.
+GENOME_REPORT_CHECKPOINT_INTERVAL = int(
+    os.getenv('GENOME_REPORT_CHECKPOINT_INTERVAL', '60'))
+
+# A report task holds a lease on its report for GENOME_REPORT_LEASE_SECONDS
+# (renewed every GENOME_REPORT_LEASE_RENEW_INTERVAL seconds while it runs,
+# including by the subtasks it starts), so no other task processes it
+# meanwhile. Tasks finding the report leased, including a redelivered task
+# whose lost run still holds it, retry after GENOME_REPORT_LEASE_RETRY_DELAY
+# seconds, so an interrupted report resumes within a few minutes. Report
+# tasks dispatched GENOME_REPORT_QUEUED_TIMEOUT seconds ago, and not holding
+# a lease, are assumed lost, and may be dispatched again.
+GENOME_REPORT_LEASE_SECONDS = int(
+    os.getenv('GENOME_REPORT_LEASE_SECONDS', '180'))
+GENOME_REPORT_LEASE_RENEW_INTERVAL = int(
+    os.getenv('GENOME_REPORT_LEASE_RENEW_INTERVAL', '30'))
+GENOME_REPORT_LEASE_RETRY_DELAY = int(
+    os.getenv('GENOME_REPORT_LEASE_RETRY_DELAY', '30'))
+GENOME_REPORT_QUEUED_TIMEOUT = int(
+    os.getenv('GENOME_REPORT_QUEUED_TIMEOUT', str(24 * 3600)))
+
+# Report tasks in progress (sent to the 'parse' queue but not finished) at
+# once, overall and for any one user. Requests beyond these wait, and are
+# dispatched round-robin across users, see tasks.dispatch_genome_reports.
+# Keep the first at least the number of 'parse' worker processes.
+GENOME_REPORT_MAX_IN_FLIGHT = int(
+    os.getenv('GENOME_REPORT_MAX_IN_FLIGHT', '4'))
+GENOME_REPORT_USER_MAX_IN_FLIGHT = int(
+    os.getenv('GENOME_REPORT_USER_MAX_IN_FLIGHT', '2'))
+
+# When a new ClinVar release is out, Celery beat has stale reports queued
+# (at bulk priority) in batches: every GENOME_REFRESH_INTERVAL seconds,
+# enough to have GENOME_REFRESH_BATCH_SIZE waiting. See
+# tasks.refresh_genome_reports, and ClinVar refreshes in the admin site for
+# progress, pausing and resuming.
+GENOME_REFRESH_INTERVAL = int(os.getenv('GENOME_REFRESH_INTERVAL', '900'))
+GENOME_REFRESH_BATCH_SIZE = int(os.getenv('GENOME_REFRESH_BATCH_SIZE', '20'))
+
 CELERY_TASK_SERIALIZER = 'json'
+# Reserve one task at a time, as report tasks are only acknowledged once
+# done (so they're redelivered if a worker stops partway).
+CELERYD_PREFETCH_MULTIPLIER = 1
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
+
+# Task queues, each consumed by its own worker in the Procfile so a backlog
+# in one doesn't hold up the others: 'parse' for genome processing (long,
+# CPU- and I/O-heavy), 'annotate' for myvariant.info refreshes (short,
+# network-bound) and 'maintenance' for anything else.
+CELERY_DEFAULT_QUEUE = 'maintenance'
+# Queues support message priorities from 0 to this (highest first, with
+# RabbitMQ), see the PRIORITY_ constants in tasks.py.
+CELERY_QUEUE_MAX_PRIORITY = 9
+# Celery 4.2 has no setting for a default message priority, so each route
+# sets one: 5, as PRIORITY_NORMAL in tasks.py. Tasks sent with a priority
+# (as report tasks are, by dispatch_genome_reports) keep theirs.
+CELERY_ROUTES = {
+    'genevieve_client.tasks.produce_genome_report': {
+        'queue': 'parse', 'priority': 5},
+    'genevieve_client.tasks.scan_genome_report_chromosomes': {
+        'queue': 'parse', 'priority': 5},
+    'genevieve_client.tasks.finish_genome_report': {
+        'queue': 'parse', 'priority': 5},
+    'genevieve_client.tasks.refresh_myvariant_data': {
+        'queue': 'annotate', 'priority': 5},
+    'genevieve_client.tasks.*': {'queue': 'maintenance', 'priority': 5},
+}
+# Periodic tasks, run by the 'beat' process in the Procfile (only ever run
+# one).
+CELERYBEAT_SCHEDULE = {
+    'refresh-genome-reports': {
+        'task': 'genevieve_client.tasks.refresh_genome_reports',
+        'schedule': GENOME_REFRESH_INTERVAL,
+    },
+}
 
 # Configure Django App for Heroku.
 django_heroku.settings(locals(), logging=not DEBUG, databases=not DEBUG)
@@ -3,232 +3,1488 @@
 # and the celery package.
 from __future__ import absolute_import
 import bz2
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+import datetime
+import fcntl
+from ftplib import FTP
 import gzip
-import json
+import io
 import os
 import re
-try:
-    import urlparse
-except ImportError:
-    import urllib.parse as urlparse
+import socket
+import threading
+import time
+import uuid
 
-from celery import shared_task
+import billiard
+from celery import chord, shared_task
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Q
 from django.utils import timezone as django_timezone
 import requests
 from vcf2clinvar import clinvar_update
-from vcf2clinvar.common import CHROM_INDEX, REV_CHROM_INDEX
-from vcf2clinvar.clinvar import ClinVarVCFLine
-from vcf2clinvar.genome import GenomeVCFLine
+from vcf2clinvar.common import CHROM_INDEX
 
-from .models import Variant, GenomeReport, GenomeVariant, CHROMOSOMES
+from . import db_match, genome_cache
+from .bgzf import load_genome_index, scan_indexed_genome, write_indexed_genome
+from .clinvar_index import ClinVarIndex
+from .genome_fingerprint import GenotypeFingerprint, GenotypeFingerprintBuilder
+from .genome_scan import (SCAN_ENGINES, genome_calls, map_chunks,
+                          read_line_chunks, scan_genome_calls,
+                          scan_genome_chunks, scan_genome_parallel,
+                          scan_genome_samples, vcf_sample_names)
+from .genome_stream import StreamingGenomeFile, prefetch
+from .models import (Variant, ClinVarDataFile, ClinVarRefresh,
+                     GenomeFingerprint, GenomeMatchResult, GenomeReport,
+                     GenomeReportCheckpoint, GenomeVariant, CHROMOSOMES,
+                     CLINVAR_DATA_LOCK_ID, DISPATCH_LOCK_ID,
+                     latest_clinvar_release)
 
-CHROM_MAP = {'chr' + v: k for k, v in CHROMOSOMES.items()}
+# ClinVar clinical significance values not considered of interest.
+CLINVAR_IGNORE_SIGS = {
+    'unknown', 'untested', 'non-pathogenic', 'not_provided',
+    'probably non-pathogenic', 'other', 'benign', 'benign/likely_benign',
+    'likely_benign'}
 
+# Task priorities: interactive requests (e.g. a user's new report) run ahead
+# of others in the same queue, and bulk reprocessing after them.
+PRIORITY_INTERACTIVE = 8
+PRIORITY_NORMAL = 5
+PRIORITY_BULK = 2
 
-def get_remote_file(url, tempdir):
+# Releases whose ClinVar data files are kept in the database, see
+# share_clinvar_data: the latest, and the one before for workers yet to
+# move on from it.
+CLINVAR_DATA_RELEASES_KEPT = 2
+
+# Version of the ClinVar filtering and matching rules, identifying memoized
+# match results (see GenomeMatchResult). Bump when these rules change.
+MATCH_FILTER_VERSION = 1
+
+# Allele sequences accepted by vcf2clinvar.
+ALLELE_RE = re.compile(r'^[ACGTN]*$|^<.*>$')
+
+# Suffix for indexed BGZF copies of genome files, and their index files.
+INDEXED_GENOME_SUFFIX = '.indexed.vcf.gz'
+
+# Suffix for ClinVar 'significant variants' index files.
+CLINVAR_SIG_SUFFIX = '.sigvariants.idx'
+
+# Process-level cache of ClinVar data, see setup_clinvar_data.
+_clinvar_sig_cache = dict()
+
+
+def open_remote_file(url):
     """
-    Get and save a remote file to temporary directory. Return filename used.
+    Start a streamed request for a remote file. Return response and filename.
     """
     req = requests.get(url, stream=True)
     if not req.status_code == 200:
         msg = ('File URL not working! Data processing aborted: {}'.format(url))
         raise Exception(msg)
-    orig_filename = ''
-    if 'Content-Disposition' in req.headers:
-        regex = re.match(r'attachment; filename="(.*)"$',
-                         req.headers['Content-Disposition'])
-        if regex:
-            orig_filename = regex.groups()[0]
-    if not orig_filename:
-        orig_filename = urlparse.urlsplit(req.url)[2].split('/')[-1]
-    tempf = open(os.path.join(tempdir, orig_filename), 'wb')
-    for chunk in req.iter_content(chunk_size=512 * 1024):
-        if chunk:
-            tempf.write(chunk)
-    tempf.close()
-    return orig_filename
+    return req, genome_cache.response_filename(req)
 
 
-def open_genome_file(genome_report):
-    local_file_dir = os.path.join(
-        settings.LOCAL_STORAGE_ROOT,
-        'local_genome_files',
-        str(genome_report.id))
-    if not os.path.exists(local_file_dir):
-        os.makedirs(local_file_dir)
-    if len(os.listdir(local_file_dir)) == 1:
-        genome_filename = os.listdir(local_file_dir)[0]
+def get_genome_cache_dir():
+    return os.path.join(settings.LOCAL_STORAGE_ROOT, 'genome_cache')
+
+
+def get_genome_cache_key(genome_report):
+    """
+    Return the genome cache key for a report's genome file.
+
+    Open Humans file URLs are signed and expire, so the Open Humans file
+    (named by report_source) is used for those instead. The file's created
+    stamp distinguishes new versions of a file at the same source.
+    """
+    if genome_report.report_source.startswith('openhumans-'):
+        source = genome_report.report_source
     else:
-        genome_report.refresh_oh_report_file_url()
-        genome_filename = get_remote_file(
-            genome_report.genome_file_url, local_file_dir)
-    genome_filepath = os.path.join(local_file_dir, genome_filename)
+        source = genome_report.genome_file_url
+    return genome_cache.source_key(source, genome_report.genome_file_created)
+
+
+def get_cached_genome_filepath(genome_report):
+    """
+    Return the local path of a report's genome file, or None if not stored.
+    """
+    return genome_cache.lookup(get_genome_cache_dir(),
+                               get_genome_cache_key(genome_report))
+
+
+def get_genome_filepath(genome_report):
+    """
+    Return the local path of a report's genome file, retrieving it if needed.
+    """
+    genome_filepath = get_cached_genome_filepath(genome_report)
+    if genome_filepath:
+        return genome_filepath
+    # This may update the file's created stamp, and so its cache key.
+    genome_report.refresh_oh_report_file_url()
+    return genome_cache.download(
+        get_genome_cache_dir(), get_genome_cache_key(genome_report),
+        genome_report.genome_file_url,
+        max_size=settings.GENOME_CACHE_MAX_SIZE,
+        retries=settings.GENOME_CACHE_DOWNLOAD_RETRIES)
+
+
+def get_indexed_genome_filepath(genome_report):
+    """
+    Return the path of a report's genome as indexed BGZF, creating if needed.
+
+    The indexed copy is stored next to the cached genome file, so they're
+    evicted together.
+    """
+    genome_filepath = get_genome_filepath(genome_report)
+    bgzf_filepath = genome_filepath + INDEXED_GENOME_SUFFIX
+    try:
+        load_genome_index(bgzf_filepath)
+    except (IOError, ValueError):
+        print("Indexing genome file for report ID: {}".format(
+            genome_report.id))
+        genome_in = open_genome_file(genome_report)
+        try:
+            write_indexed_genome(genome_in, bgzf_filepath)
+        finally:
+            genome_in.close()
+    return bgzf_filepath
+
+
+def open_streaming_genome_file(genome_report):
+    """
+    Open a report's remote genome file, to be read as it downloads.
+
+    The download runs on a separate thread, so it overlaps with matching.
+    If GENOME_FILE_STREAMING_CACHE is set, the downloaded file is also
+    added to the genome cache, once it has been read to the end.
+    """
+    genome_report.refresh_oh_report_file_url()
+    req, orig_filename = open_remote_file(genome_report.genome_file_url)
+    cache_dir = get_genome_cache_dir()
+    cache_key = get_genome_cache_key(genome_report)
+    cache_filepath = None
+    if settings.GENOME_FILE_STREAMING_CACHE:
+        cache_filepath = os.path.join(
+            genome_cache.tmp_dir(cache_dir),
+            '{}.streamed{}'.format(cache_key, os.getpid()))
+    chunks = prefetch(req.iter_content(chunk_size=512 * 1024))
+
+    def close_request():
+        chunks.close()
+        req.close()
+
+    def add_to_cache(filepath):
+        genome_cache.add_file(cache_dir, cache_key, filepath, orig_filename,
+                              max_size=settings.GENOME_CACHE_MAX_SIZE)
+    return io.BufferedReader(
+        StreamingGenomeFile(chunks, orig_filename,
+                            cache_filepath=cache_filepath,
+                            on_close=close_request, on_cached=add_to_cache),
+        buffer_size=1024 * 1024)
+
+
+def genome_file_samples(url):
+    """
+    Return the sample names in a remote genome VCF file's header.
+
+    Only as much of the file as the header takes is downloaded, and no
+    more than GENOME_FILE_HEADER_MAX_SIZE bytes of it (decompressed).
+    """
+    req, orig_filename = open_remote_file(url)
+    genome_in = io.BufferedReader(StreamingGenomeFile(
+        req.iter_content(chunk_size=64 * 1024), orig_filename,
+        on_close=req.close))
+    try:
+        return vcf_sample_names(genome_in,
+                                settings.GENOME_FILE_HEADER_MAX_SIZE)
+    finally:
+        genome_in.close()
+
+
+def open_genome_file(genome_report):
+    """
+    Open a report's genome file, decompressed, in binary mode.
+
+    With GENOME_FILE_STREAMING set, a file not already stored locally is
+    read as it downloads, rather than downloaded first.
+    """
+    if (settings.GENOME_FILE_STREAMING and
+            not get_cached_genome_filepath(genome_report)):
+        return open_streaming_genome_file(genome_report)
+    genome_filepath = get_genome_filepath(genome_report)
     if genome_filepath.endswith('.bz2'):
         genome_in = bz2.BZ2File(genome_filepath, 'rb')
     elif genome_filepath.endswith('.gz'):
         genome_in = gzip.open(genome_filepath, 'rb')
     else:
-        genome_in = open(genome_filepath)
+        genome_in = open(genome_filepath, 'rb')
     return genome_in
 
 
-def _next_line(filebuffer):
-    try:
-        next_line = filebuffer.readline()
-    except AttributeError:
-        next_line = filebuffer.next()
-    try:
-        next_line = next_line.decode('utf-8')
-        return next_line
-    except AttributeError:
-        return next_line
+def _clinvar_sig_from_chunk(chunk):
+    """
+    Return 'significant' (chrom, pos, ref, alt) tuples for ClinVar VCF lines.
+
+    A lightweight equivalent to parsing with ClinVarVCFLine: only the CLNSIG
+    and CLNDN INFO tags are read, and filtered records are dropped before any
+    other parsing happens.
+    """
+    clinvar_sig = list()
+    for line in chunk.decode('utf-8').splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = line.rstrip().split('\t', 8)
+        # Skip unplaced contigs, these can't be stored as Variants.
+        chrom = CHROM_INDEX.get(fields[0])
+        if not chrom:
+            continue
+        info = dict(item.split('=') for item in fields[7].split(';') if
+                    item.count('=') == 1)
+        clnsig = info.get('CLNSIG')
+        # Variants only reported in combination with others have no CLNSIG.
+        if not clnsig or clnsig.lower() in CLINVAR_IGNORE_SIGS:
+            continue
+        if clnsig.lower() == 'uncertain_significance':
+            clndn = info['CLNDN'].split('|') if 'CLNDN' in info else []
+            meaningful_diseases = [
+                x for x in clndn if x.lower() not in ['not_specified']
+            ]
+            if not meaningful_diseases:
+                continue
+        # ClinVar records one allele: the first ALT, or REF if there's none.
+        ref_allele = fields[3]
+        if fields[4] == '.':
+            sequence = ref_allele
+        else:
+            sequence = fields[4].split(',')[0]
+        if not ALLELE_RE.match(sequence):
+            continue
+        clinvar_sig.append((chrom, int(fields[1]), ref_allele, sequence))
+    return clinvar_sig
 
 
-def generate_clinvar_sig(clinvar_filepath, clinvar_sig_filepath):
+def generate_clinvar_sig(clinvar_filepath, clinvar_sig_filepath, build):
+    """
+    Generate and save the ClinVar 'significant variants' index.
+
+    The decompressed ClinVar VCF is split into line-aligned chunks which are
+    parsed on a process pool, results are merged in file order.
+    """
     print("Generating new ClinVar 'significant variants' list...")
     if clinvar_filepath.endswith('.bz2'):
-        clinvar_file = bz2.BZ2File(clinvar_filepath, 'rt')
+        clinvar_file = bz2.BZ2File(clinvar_filepath, 'rb')
     elif clinvar_filepath.endswith('.gz'):
-        clinvar_file = gzip.open(clinvar_filepath, 'rt')
+        clinvar_file = gzip.open(clinvar_filepath, 'rb')
     else:
-        clinvar_file = open(clinvar_filepath)
+        clinvar_file = open(clinvar_filepath, 'rb')
+    chunks = read_line_chunks(
+        clinvar_file, settings.CLINVAR_PREPROCESS_CHUNK_SIZE)
     clinvar_sig = list()
 
-    i = 0
-    clin_curr_line = _next_line(clinvar_file)
-    while clin_curr_line.startswith('#'):
-        clin_curr_line = _next_line(clinvar_file)
-    while clin_curr_line:
-        i += 1
-        if i % 10000 == 0:
-            print("{} ClinVar lines processed...".format(i))
-        clinvar_vcf_line = ClinVarVCFLine(vcf_line=clin_curr_line)
-        for allele in clinvar_vcf_line.alleles:
-            ignore_sigs = ['unknown', 'untested', 'non-pathogenic',
-                           'not_provided', 'probably non-pathogenic', 'other',
-                           'benign', 'benign/likely_benign', 'likely_benign']
-            if allele.clnsig.lower() in ignore_sigs:
-                continue
-            if allele.clnsig.lower() == 'uncertain_significance':
-                meaningful_diseases = [
-                    x for x in allele.clndn if x.lower() not in
-                    ['not_specified']
-                ]
-                if not meaningful_diseases:
-                    continue
-            varstring = '{}-{}-{}-{}'.format(
-                clinvar_vcf_line.chrom,
-                clinvar_vcf_line.start,
-                clinvar_vcf_line.ref_allele,
-                allele.sequence)
-            clinvar_sig.append(varstring)
-
-        clin_curr_line = _next_line(clinvar_file)
-
-    assert clinvar_sig_filepath.endswith('.json.gz')
-    with gzip.open(clinvar_sig_filepath, 'wt') as f:
-        json.dump(clinvar_sig, f)
-    return clinvar_sig
+    processes = settings.CLINVAR_PREPROCESS_PROCESSES or billiard.cpu_count()
+    try:
+        for i, chunk_sig in enumerate(map_chunks(
+                _clinvar_sig_from_chunk, chunks, processes), 1):
+            clinvar_sig.extend(chunk_sig)
+            print("{} ClinVar chunks processed...".format(i))
+    finally:
+        clinvar_file.close()
 
+    release = os.path.basename(clinvar_filepath)[len(build) + 1:]
+    ClinVarIndex.from_variants(
+        clinvar_sig, build=build, release=release).save(clinvar_sig_filepath)
 
-def setup_clinvar_data():
+
+def get_clinvar_delta_filepaths(clinvar_sig_filepath, from_release):
+    """
+    Return paths for indexes of variants added and removed since a release.
+    """
+    delta_filepath = '{}.delta-from-{}'.format(
+        clinvar_sig_filepath, from_release)
+    return delta_filepath + '.added.idx', delta_filepath + '.removed.idx'
+
+
+def generate_clinvar_delta(clinvar_sig):
+    """
+    Save the changes in ClinVar 'significant variants' since the last release.
+
+    The previous release is the latest older index stored alongside, or
+    shared in the database (see share_clinvar_data), if any. Variants added
+    and removed since then are saved as two indexes (see
+    get_clinvar_delta_filepaths), so reports last matched against the
+    previous release can be updated by matching the changes alone.
+    """
+    clinvar_sig_dir, clinvar_sig_filename = os.path.split(
+        clinvar_sig.filepath)
+    shared_filename = ClinVarDataFile.objects.filter(
+        filename__endswith=CLINVAR_SIG_SUFFIX,
+        filename__lt=clinvar_sig_filename).order_by('-filename').values_list(
+        'filename', flat=True).first()
+    if shared_filename and not os.path.exists(
+            os.path.join(clinvar_sig_dir, shared_filename)):
+        fetch_clinvar_data(ClinVarDataFile.objects.filter(
+            filename=shared_filename))
+    previous_filenames = sorted(
+        f for f in os.listdir(clinvar_sig_dir) if
+        f.endswith(CLINVAR_SIG_SUFFIX) and f < clinvar_sig_filename)
+    if not previous_filenames:
+        return
+    try:
+        previous_sig = ClinVarIndex.load(
+            os.path.join(clinvar_sig_dir, previous_filenames[-1]))
+    except (IOError, ValueError):
+        return
+    variants = set(clinvar_sig)
+    previous_variants = set(previous_sig)
+    added_filepath, removed_filepath = get_clinvar_delta_filepaths(
+        clinvar_sig.filepath, previous_sig.release)
+    ClinVarIndex.from_variants(
+        variants - previous_variants, build=clinvar_sig.build,
+        release=clinvar_sig.release).save(added_filepath)
+    ClinVarIndex.from_variants(
+        previous_variants - variants, build=clinvar_sig.build,
+        release=clinvar_sig.release).save(removed_filepath)
+    print("ClinVar changes since {}: {} variants added, {} removed".format(
+        previous_sig.release, len(variants - previous_variants),
+        len(previous_variants - variants)))
+
+
+def load_clinvar_delta(clinvar_sig, from_release):
+    """
+    Return indexes of variants (added, removed) since a release, or None.
+    """
+    try:
+        return tuple(ClinVarIndex.load(filepath) for filepath in
+                     get_clinvar_delta_filepaths(clinvar_sig.filepath,
+                                                 from_release))
+    except (IOError, ValueError):
+        return None
+
+
+def get_clinvar_storage_dir():
+    """
+    Return the directory holding ClinVar files, creating it if needed.
+    """
     local_storage = os.path.join(settings.LOCAL_STORAGE_ROOT,
                                  'genome_processing_files')
     if not os.path.exists(local_storage):
         os.makedirs(local_storage)
-    clinvar_filepath = clinvar_update.get_latest_vcf_file(
-        target_dir=local_storage, build='b37')
-    clinvar_sig_filepath = '{}.sigposlist.json.gz'.format(clinvar_filepath)
-    if os.path.exists(clinvar_sig_filepath):
-        clinvar_sig_file = gzip.open(clinvar_sig_filepath, 'rt')
-        clinvar_sig = json.load(clinvar_sig_file)
+    return local_storage
+
+
+def download_clinvar_file(clinvar_filename, clinvar_filepath):
+    """
+    Download a ClinVar release file from NCBI's FTP site.
+
+    It's written to a temporary file and renamed into place, so an
+    interrupted download is never taken for the release.
+    """
+    print("Downloading ClinVar release {}...".format(clinvar_filename))
+    tmp_filepath = '{}.tmp{}'.format(clinvar_filepath, os.getpid())
+    ftp = FTP('ftp.ncbi.nlm.nih.gov')
+    try:
+        ftp.login()
+        clinvar_update.nav_to_vcf_dir(ftp, build='b37')
+        with open(tmp_filepath, 'wb') as f:
+            ftp.retrbinary('RETR {}'.format(clinvar_filename), f.write)
+        os.rename(tmp_filepath, clinvar_filepath)
+    finally:
+        ftp.close()
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+def fetch_clinvar_data(data_files):
+    """
+    Copy shared ClinVar data files to local storage, returning their names.
+    """
+    local_storage = get_clinvar_storage_dir()
+    filenames = []
+    for filename, data in data_files.values_list('filename', 'data'):
+        filepath = os.path.join(local_storage, filename)
+        tmp_filepath = '{}.tmp{}'.format(filepath, os.getpid())
+        with open(tmp_filepath, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_filepath, filepath)
+        filenames.append(filename)
+    return filenames
+
+
+def share_clinvar_data(clinvar_sig):
+    """
+    Store a ClinVar index and its delta files in the database.
+
+    Other workers then copy them (see make_clinvar_data) rather than make
+    them again. Files for all but the latest CLINVAR_DATA_RELEASES_KEPT
+    releases are deleted.
+    """
+    clinvar_sig_dir, clinvar_sig_filename = os.path.split(
+        clinvar_sig.filepath)
+    with transaction.atomic():
+        for filename in os.listdir(clinvar_sig_dir):
+            if filename != clinvar_sig_filename and not (
+                    filename.startswith(clinvar_sig_filename + '.delta-from-')
+                    and filename.endswith('.idx')):
+                continue
+            with open(os.path.join(clinvar_sig_dir, filename), 'rb') as f:
+                ClinVarDataFile.objects.update_or_create(
+                    filename=filename, defaults={
+                        'clinvar_release': clinvar_sig.release,
+                        'data': f.read()})
+        kept_releases = list(ClinVarDataFile.objects.order_by(
+            '-clinvar_release').values_list(
+            'clinvar_release', flat=True).distinct()[
+            :CLINVAR_DATA_RELEASES_KEPT])
+        ClinVarDataFile.objects.exclude(
+            clinvar_release__in=kept_releases).delete()
+
+
+def make_clinvar_data(clinvar_filename, clinvar_filepath):
+    """
+    Set up a ClinVar release's index and delta files in local storage.
+
+    They're copied from the database if another worker has made them.
+    Otherwise they're made here and shared, by one worker at a time so
+    others wait to copy them rather than make them too.
+    """
+    clinvar_sig_filepath = clinvar_filepath + CLINVAR_SIG_SUFFIX
+    clinvar_sig_filename = os.path.basename(clinvar_sig_filepath)
+    data_files = ClinVarDataFile.objects.filter(
+        clinvar_release=clinvar_filename)
+    if clinvar_sig_filename in fetch_clinvar_data(data_files):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', [CLINVAR_DATA_LOCK_ID])
+    try:
+        if clinvar_sig_filename in fetch_clinvar_data(data_files):
+            return
+        if not os.path.exists(clinvar_filepath):
+            download_clinvar_file(clinvar_filename, clinvar_filepath)
+        generate_clinvar_sig(clinvar_filepath, clinvar_sig_filepath,
+                             build='b37')
+        clinvar_sig = ClinVarIndex.load(clinvar_sig_filepath)
+        generate_clinvar_delta(clinvar_sig)
+        share_clinvar_data(clinvar_sig)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)',
+                           [CLINVAR_DATA_LOCK_ID])
+
+
+def _cache_clinvar_sig(clinvar_filepath, clinvar_sig):
+    # Replace rather than update, so the previous release can be freed.
+    _clinvar_sig_cache.clear()
+    _clinvar_sig_cache.update({
+        'clinvar_filepath': clinvar_filepath,
+        'clinvar_sig': clinvar_sig,
+    })
+    return clinvar_sig
+
+
+def load_local_clinvar_data():
+    """
+    Load the newest ClinVar index already on disk, if any, for reuse.
+
+    Nothing is looked up, downloaded or generated, so this is quick enough
+    to run as a worker process starts. Returns the index, or None.
+    """
+    local_storage = get_clinvar_storage_dir()
+    for clinvar_sig_filename in sorted((
+            f for f in os.listdir(local_storage) if
+            f.endswith(CLINVAR_SIG_SUFFIX)), reverse=True):
+        clinvar_sig_filepath = os.path.join(local_storage,
+                                            clinvar_sig_filename)
+        try:
+            clinvar_sig = ClinVarIndex.load(clinvar_sig_filepath)
+        except (IOError, ValueError):
+            continue
+        return _cache_clinvar_sig(
+            clinvar_sig_filepath[:-len(CLINVAR_SIG_SUFFIX)], clinvar_sig)
+    return None
+
+
+def setup_clinvar_data():
+    """
+    Return the ClinVar 'significant variants' index for the latest release.
+
+    The latest release is taken from models.latest_clinvar_release. Its
+    index is copied from the database, or else its file downloaded and
+    indexed, only if not already stored locally. The index is kept for the
+    life of the worker process and only reloaded when a newer ClinVar
+    release appears.
+    """
+    local_storage = get_clinvar_storage_dir()
+    clinvar_filename = latest_clinvar_release()[0]
+    # Named as by clinvar_update.get_latest_vcf_file.
+    clinvar_filepath = os.path.join(local_storage, 'b37_' + clinvar_filename)
+    if _clinvar_sig_cache.get('clinvar_filepath') == clinvar_filepath:
+        return _clinvar_sig_cache['clinvar_sig']
+    clinvar_sig_filepath = clinvar_filepath + CLINVAR_SIG_SUFFIX
+    try:
+        clinvar_sig = ClinVarIndex.load(clinvar_sig_filepath)
+    except (IOError, ValueError):
+        # Set up once: other processes wait for it, then load its index.
+        with open(clinvar_sig_filepath + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                clinvar_sig = ClinVarIndex.load(clinvar_sig_filepath)
+            except (IOError, ValueError):
+                make_clinvar_data(clinvar_filename, clinvar_filepath)
+                clinvar_sig = ClinVarIndex.load(clinvar_sig_filepath)
+    return _cache_clinvar_sig(clinvar_filepath, clinvar_sig)
+
+
+def store_variants(hits):
+    """
+    Return (variant_id, zygosity) pairs for a batch of ClinVar hits.
+
+    Each hit is a (chrom, pos, ref_allele, var_allele, zygosity) tuple. Missing
+    Variants are created with one conflict-tolerant bulk insert.
+    """
+    if not hits:
+        return set()
+    variant_keys = {(int(h[0]), int(h[1]), h[2], h[3]) for h in hits}
+    Variant.objects.bulk_create([
+        Variant(chromosome=chrom,
+                pos=pos,
+                ref_allele=ref_allele,
+                var_allele=var_allele,
+                myvariant_clinvar={},
+                myvariant_exac={},
+                myvariant_gnomad_genome={}) for
+        chrom, pos, ref_allele, var_allele in variant_keys
+    ], ignore_conflicts=True)
+
+    # Conflicting rows aren't returned by bulk_create, so look up all IDs.
+    variant_ids = {
+        (v.chromosome, v.pos, v.ref_allele, v.var_allele): v.id for v in
+        Variant.objects.filter(pos__in={k[1] for k in variant_keys}).only(
+            'id', 'chromosome', 'pos', 'ref_allele', 'var_allele')}
+    return {(variant_ids[(int(chrom), int(pos), ref_allele, var_allele)],
+             zygosity) for
+            chrom, pos, ref_allele, var_allele, zygosity in hits}
+
+
+def print_scan_stats(genome_report_ids, stats):
+    """
+    Print counts of genome records read, skipped and examined by a scan.
+    """
+    skipped = sum(stats[reason] for reason in
+                  ('reference_blocks', 'hom_ref', 'no_call'))
+    print('Scanned genome for GenomeReport {}: {} records, {} skipped '
+          '({} reference blocks, {} hom-ref, {} no-call), {} examined'.format(
+              ', '.join(str(i) for i in genome_report_ids),
+              stats['records'], skipped, stats['reference_blocks'],
+              stats['hom_ref'], stats['no_call'], stats['examined']))
+
+
+def get_scan_key(genome_report, clinvar_sig):
+    """
+    Return a key identifying a scan of a report's genome file, for checkpoints.
+    """
+    return genome_cache.source_key(
+        get_genome_cache_key(genome_report), genome_report.vcf_sample,
+        clinvar_sig.filepath, settings.GENOME_SCAN_ENGINE)
+
+
+def skip_bytes(genome_in, size):
+    """
+    Read and discard size bytes from a file (which may not support seek).
+    """
+    while size > 0:
+        block = genome_in.read(min(size, 1024 * 1024))
+        if not block:
+            raise EOFError('Genome file ended before its scan checkpoint')
+        size -= len(block)
+
+
+def checkpointed_hits(genome_report, clinvar_sig, genome_in, processes,
+                      stats):
+    """
+    Yield ClinVar hits from a genome file, saving checkpoints of progress.
+
+    Every GENOME_REPORT_CHECKPOINT_INTERVAL seconds, the number of
+    decompressed bytes scanned is saved to the report's
+    GenomeReportCheckpoint, with the hits and stats found so far. If that
+    holds a checkpoint of the same scan (e.g. the task was interrupted and
+    redelivered), its hits are yielded and scanning resumes from there.
+    complete_genome_report removes the checkpoint.
+    """
+    scan_key = get_scan_key(genome_report, clinvar_sig)
+    checkpoint, _ = GenomeReportCheckpoint.objects.get_or_create(
+        genome_report=genome_report)
+    if checkpoint.scan_key == scan_key:
+        print("Resuming genome scan for report ID {} from byte {}".format(
+            genome_report.id, checkpoint.offset))
+        skip_bytes(genome_in, checkpoint.offset)
+    else:
+        checkpoint.scan_key = scan_key
+        checkpoint.offset = 0
+        checkpoint.hits = []
+        checkpoint.stats = {}
+    stats.update(checkpoint.stats)
+    for hit in checkpoint.hits:
+        yield tuple(hit)
+
+    last_saved = time.time()
+    for size, hits, chunk_stats in scan_genome_chunks(
+            genome_in, clinvar_sig, settings.GENOME_SCAN_ENGINE, processes):
+        stats.update(chunk_stats)
+        checkpoint.offset += size
+        checkpoint.hits.extend(hits)
+        for hit in hits:
+            yield hit
+        if (time.time() - last_saved >=
+                settings.GENOME_REPORT_CHECKPOINT_INTERVAL):
+            checkpoint.stats = dict(stats)
+            checkpoint.save()
+            last_saved = time.time()
+    checkpoint.stats = dict(stats)
+    checkpoint.save()
+
+
+def genome_report_hits(genome_report, clinvar_sig, processes=1,
+                       checkpoint=False):
+    """
+    Yield ClinVar hits from a report's genome file.
+
+    Reports on a vcf_sample are scanned for that sample's genotypes. Others
+    use the indexed copy of the file if GENOME_FILE_INDEXING is set, or the
+    configured scan engine (on a process pool if processes > 1) otherwise.
+    With checkpoint set, scans by scan engine save their progress (see
+    checkpointed_hits). Counts of records read, skipped and examined are
+    printed once done.
+    """
+    stats = Counter()
+    genome_in = None
+    if genome_report.vcf_sample:
+        genome_in = open_genome_file(genome_report)
+        genome_hits = (hit for _, hit in scan_genome_samples(
+            genome_in, clinvar_sig, [genome_report.vcf_sample], stats))
+    elif settings.GENOME_FILE_INDEXING:
+        genome_hits = scan_indexed_genome(
+            get_indexed_genome_filepath(genome_report), clinvar_sig, stats)
     else:
-        clinvar_sig = generate_clinvar_sig(
-            clinvar_filepath, clinvar_sig_filepath)
-    return set(clinvar_sig)
-
-
-def get_zyg(genome_vcf_line):
-    genotype_allele_indexes = genome_vcf_line.genotype_allele_indexes
-    genome_alleles = [genome_vcf_line.alleles[x] for
-                      x in genotype_allele_indexes]
-    if len(genome_alleles) == 1:
-        return 'Hem'
-    elif len(genome_alleles) == 2:
-        if genome_alleles[0].sequence == genome_alleles[1].sequence:
-            return 'Hom'
-            genome_alleles = [genome_alleles[0]]
+        genome_in = open_genome_file(genome_report)
+        if checkpoint and settings.GENOME_REPORT_CHECKPOINT_INTERVAL:
+            genome_hits = checkpointed_hits(
+                genome_report, clinvar_sig, genome_in, processes, stats)
+        elif processes > 1:
+            genome_hits = scan_genome_parallel(
+                genome_in, clinvar_sig, engine=settings.GENOME_SCAN_ENGINE,
+                processes=processes, stats=stats)
         else:
-            return 'Het'
+            genome_hits = SCAN_ENGINES[settings.GENOME_SCAN_ENGINE](
+                genome_in, clinvar_sig, stats)
+    try:
+        for hit in genome_hits:
+            yield hit
+    finally:
+        if genome_in:
+            genome_in.close()
+    print_scan_stats([genome_report.id], stats)
 
 
-@shared_task(task_serializer='json')
-def produce_genome_report(genome_report_id, reprocess=False):
+def get_genome_fingerprint_key(genome_report):
+    """
+    Return the key for a report's genotype fingerprint.
+
+    It's made from the genome file's cache key and the report's sample, so
+    a new version of the genome file doesn't reuse an old fingerprint.
+    """
+    return genome_cache.source_key(get_genome_cache_key(genome_report),
+                                   genome_report.vcf_sample)
+
+
+def get_genome_fingerprint_filepath(genome_report):
+    """
+    Return the path for the local copy of a report's genotype fingerprint.
+    """
+    fingerprint_dir = os.path.join(
+        settings.LOCAL_STORAGE_ROOT, 'genome_fingerprints')
+    if not os.path.exists(fingerprint_dir):
+        os.makedirs(fingerprint_dir)
+    return os.path.join(fingerprint_dir, '{}.fp'.format(
+        get_genome_fingerprint_key(genome_report)))
+
+
+def load_genome_fingerprint(genome_report):
+    """
+    Return a report's genotype fingerprint, or None if it has none.
+
+    If not stored locally, it's copied from the database, where
+    save_genome_fingerprint shares it with all workers.
+    """
+    fingerprint_filepath = get_genome_fingerprint_filepath(genome_report)
+    if not os.path.exists(fingerprint_filepath):
+        data = GenomeFingerprint.objects.filter(
+            key=get_genome_fingerprint_key(genome_report)).values_list(
+            'data', flat=True).first()
+        if data is None:
+            return None
+        tmp_filepath = '{}.tmp{}'.format(fingerprint_filepath, os.getpid())
+        with open(tmp_filepath, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_filepath, fingerprint_filepath)
+    try:
+        return GenotypeFingerprint.load(fingerprint_filepath)
+    except (IOError, ValueError):
+        return None
+
+
+def save_genome_fingerprint(genome_report, fingerprint):
+    """
+    Save a report's genotype fingerprint locally and in the database.
+    """
+    fingerprint_filepath = get_genome_fingerprint_filepath(genome_report)
+    fingerprint.save(fingerprint_filepath)
+    with open(fingerprint_filepath, 'rb') as f:
+        GenomeFingerprint.objects.update_or_create(
+            key=get_genome_fingerprint_key(genome_report),
+            defaults={'data': f.read()})
+
+
+def fingerprint_hits(genome_report, clinvar_sig):
+    """
+    Yield ClinVar hits for a report from its genotype fingerprint.
+
+    If the report has no fingerprint yet, its genome file is scanned once
+    for all ALT allele calls, which are saved as its fingerprint.
+    """
+    fingerprint = load_genome_fingerprint(genome_report)
+    if fingerprint is not None:
+        for hit in fingerprint.matches(clinvar_sig):
+            yield hit
+        return
+
+    stats = Counter()
+    calls = GenotypeFingerprintBuilder()
+    genome_in = open_genome_file(genome_report)
+    try:
+        for hit in scan_genome_calls(genome_in, clinvar_sig, calls,
+                                     genome_report.vcf_sample, stats):
+            yield hit
+    finally:
+        genome_in.close()
+    print_scan_stats([genome_report.id], stats)
+    # Opening the file may have updated its created stamp, so the key is
+    # looked up again.
+    save_genome_fingerprint(genome_report, calls.build())
+
+
+def get_genome_sha256(genome_report):
+    """
+    Return the content hash of a report's genome file, or None if unknown.
+
+    The hash is only known once the file is cached locally: it's never
+    retrieved just for this, as a rematch may not need the file at all
+    (e.g. with GENOME_FINGERPRINTS).
+    """
+    genome_filepath = get_cached_genome_filepath(genome_report)
+    if not genome_filepath:
+        return None
+    return genome_cache.content_hash(genome_filepath)
+
+
+def get_match_filter_version():
+    """
+    Return the version of the matching rules in use, for GenomeMatchResult.
+    """
+    # These modes (used ahead of the scan engine, see run_genome_report) only
+    # read ALT allele calls, so don't match ClinVar records without an ALT
+    # allele.
+    if settings.GENOME_FINGERPRINTS or settings.GENOME_MATCH_IN_DATABASE:
+        return '{}-alt'.format(MATCH_FILTER_VERSION)
+    # The gVCF engine skips hom-ref calls, but still matches such records
+    # on other calls.
+    if settings.GENOME_SCAN_ENGINE == 'gvcf':
+        return '{}-gvcf'.format(MATCH_FILTER_VERSION)
+    return str(MATCH_FILTER_VERSION)
+
+
+def get_match_result(genome_report, clinvar_release):
+    """
+    Return memoized ClinVar hits for a report's genome file, or None.
+    """
+    genome_sha256 = get_genome_sha256(genome_report)
+    if not genome_sha256:
+        return None
+    match_result = GenomeMatchResult.objects.filter(
+        genome_sha256=genome_sha256,
+        vcf_sample=genome_report.vcf_sample,
+        clinvar_release=clinvar_release,
+        filter_version=get_match_filter_version()).first()
+    if match_result:
+        return [tuple(hit) for hit in match_result.hits]
+    return None
+
+
+def save_match_result(genome_report, clinvar_release, hits):
+    """
+    Memoize ClinVar hits for a report's genome file, if its hash is known.
+    """
+    genome_sha256 = get_genome_sha256(genome_report)
+    if not genome_sha256:
+        return
+    GenomeMatchResult.objects.bulk_create([GenomeMatchResult(
+        genome_sha256=genome_sha256,
+        vcf_sample=genome_report.vcf_sample,
+        clinvar_release=clinvar_release,
+        filter_version=get_match_filter_version(),
+        hits=[list(hit) for hit in hits])], ignore_conflicts=True)
+
+
+def complete_genome_report(genome_report, genome_hits, clinvar_release,
+                           delete_ids=None, memoize=False):
+    """
+    Update a GenomeReport's variants to ClinVar hits, and mark it processed.
+
+    Variants are created in batches as hits arrive. The report's
+    GenomeVariants are then changed in one short transaction at the end,
+    only inserting and deleting rows that differ, so readers see the old
+    report until then. Rows not among the hits are deleted, unless
+    delete_ids is given, in which case only those rows are. If memoize is
+    set, the hits are also saved for reuse by reports of the same file.
+    """
+    genome_variants = set()
+    all_hits = []
+    hits = []
+    for hit in genome_hits:
+        # If it appears to be significant, store this as a GenomeVariant.
+        hits.append(hit)
+        if len(hits) >= settings.GENOME_REPORT_WRITE_BATCH_SIZE:
+            genome_variants.update(store_variants(hits))
+            all_hits.extend(hits)
+            hits = []
+    genome_variants.update(store_variants(hits))
+    all_hits.extend(hits)
+
+    with transaction.atomic():
+        # Serialize concurrent updates of the same report.
+        GenomeReport.objects.select_for_update().filter(
+            id=genome_report.id).exists()
+        existing = {
+            (variant_id, zygosity): genome_variant_id for
+            genome_variant_id, variant_id, zygosity in
+            GenomeVariant.objects.filter(genome=genome_report).values_list(
+                'id', 'variant_id', 'zygosity')}
+        if delete_ids is None:
+            delete_ids = [genome_variant_id for key, genome_variant_id in
+                          existing.items() if key not in genome_variants]
+        GenomeVariant.objects.filter(id__in=delete_ids).delete()
+        GenomeReportCheckpoint.objects.filter(
+            genome_report=genome_report).delete()
+        new_genome_variants = genome_variants.difference(existing)
+        GenomeVariant.objects.bulk_create([
+            GenomeVariant(genome=genome_report,
+                          variant_id=variant_id,
+                          zygosity=zygosity) for
+            variant_id, zygosity in new_genome_variants],
+            batch_size=settings.GENOME_REPORT_WRITE_BATCH_SIZE)
+        genome_report.last_processed = django_timezone.now()
+        genome_report.clinvar_release = clinvar_release
+        genome_report.save(
+            update_fields=['last_processed', 'clinvar_release'])
+    print("Updated GenomeReport {}: {} variants added, {} deleted".format(
+        genome_report.id, len(new_genome_variants), len(delete_ids)))
+    if memoize:
+        save_match_result(genome_report, clinvar_release, all_hits)
+    genome_report.refresh_myvariant_data()
+
+
+def database_match_genome_report(genome_report, clinvar_sig):
+    """
+    Update a GenomeReport by matching its genome file in the database.
+
+    See db_match.match_genome_report. The ClinVar release is loaded into
+    the database first, if it hasn't been already.
+    """
+    db_match.load_clinvar_table(clinvar_sig)
+    stats = Counter()
+    genome_in = open_genome_file(genome_report)
+    try:
+        hits, added, deleted = db_match.match_genome_report(
+            genome_report, genome_calls(
+                genome_in, genome_report.vcf_sample, stats),
+            clinvar_sig.release)
+    finally:
+        genome_in.close()
+    print_scan_stats([genome_report.id], stats)
+    print("Updated GenomeReport {}: {} variants added, {} deleted".format(
+        genome_report.id, added, deleted))
+    save_match_result(genome_report, clinvar_sig.release, hits)
+    genome_report.refresh_myvariant_data()
+
+
+def has_indexed_genome(genome_report):
+    """
+    True if genome_report_hits would read a report's indexed genome copy.
+
+    That's with GENOME_FILE_INDEXING, for reports not on a vcf_sample, if
+    the indexed copy of the genome file is already stored.
+    """
+    if not settings.GENOME_FILE_INDEXING or genome_report.vcf_sample:
+        return False
+    genome_filepath = get_cached_genome_filepath(genome_report)
+    if not genome_filepath:
+        return False
+    try:
+        load_genome_index(genome_filepath + INDEXED_GENOME_SUFFIX)
+    except (IOError, ValueError):
+        return False
+    return True
+
+
+def apply_clinvar_delta(genome_report, clinvar_sig, added, removed):
+    """
+    Update a report for the variants added to and removed from ClinVar.
+
+    Only GenomeVariants for removed variants are deleted, in the same
+    transaction that stores those for added variants. Added variants are
+    matched using the report's genotype fingerprint if it has one, or else
+    its indexed genome copy. Without either, matching them would read the
+    whole genome file, so the report is left unchanged and False returned,
+    for it to be rematched in full instead (which creates its fingerprint,
+    with GENOME_FINGERPRINTS).
+    """
+    fingerprint = load_genome_fingerprint(genome_report)
+    if fingerprint is not None:
+        genome_hits = fingerprint.matches(added)
+    elif has_indexed_genome(genome_report):
+        genome_hits = genome_report_hits(genome_report, added)
+    else:
+        return False
+    removed_ids = [
+        gv.id for gv in genome_report.genomevariant_set.select_related(
+            'variant') if
+        removed.contains(gv.variant.chromosome, gv.variant.pos,
+                         gv.variant.ref_allele, gv.variant.var_allele)]
+    print("Applying ClinVar changes to report ID {}: {} variants added, "
+          "{} removed, {} GenomeVariants removed".format(
+              genome_report.id, len(added), len(removed), len(removed_ids)))
+    complete_genome_report(genome_report, genome_hits, clinvar_sig.release,
+                           delete_ids=removed_ids)
+    return True
+
+
+def chromosome_groups(clinvar_sig, count):
+    """
+    Split chromosomes into consecutive (first, last) ranges for subtasks.
+
+    Ranges hold roughly equal numbers of ClinVar variants.
+    """
+    chrom_sizes = [(chrom, len(clinvar_sig.chromosome_range(chrom, chrom)))
+                   for chrom in CHROMOSOMES]
+    target = len(clinvar_sig) / float(count)
+    groups = []
+    group_start, group_size = None, 0
+    for chrom, size in chrom_sizes:
+        if group_start is None:
+            group_start = chrom
+        group_size += size
+        if group_size >= target and len(groups) < count - 1:
+            groups.append((group_start, chrom))
+            group_start, group_size = None, 0
+    if group_start is not None:
+        groups.append((group_start, chrom_sizes[-1][0]))
+    return groups
+
+
+def queue_genome_report(genome_report_id, reprocess=False,
+                        priority=PRIORITY_NORMAL):
+    """
+    Request processing of a report, started by dispatch_genome_reports.
+
+    Requests made while a report's earlier request is waiting (or its task
+    hasn't started) are merged into it, reprocessing in full if any of them
+    asked to. A report so has at most one task waiting, besides one
+    running.
+    """
+    with transaction.atomic():
+        genome_report = GenomeReport.objects.select_for_update().get(
+            id=genome_report_id)
+        queued = bool(genome_report.task_queued)
+        if queued:
+            genome_report.task_reprocess = (
+                genome_report.task_reprocess or reprocess)
+            # Priority can only be raised until the task is dispatched.
+            genome_report.task_priority = max(genome_report.task_priority,
+                                              priority)
+        else:
+            genome_report.task_queued = django_timezone.now()
+            genome_report.task_reprocess = reprocess
+            genome_report.task_priority = priority
+        genome_report.save(update_fields=[
+            'task_queued', 'task_reprocess', 'task_priority'])
+    if queued:
+        print("Report ID {} already queued for processing".format(
+            genome_report_id))
+    dispatch_genome_reports()
+
+
+def dispatch_genome_reports():
+    """
+    Start report tasks for queued requests, sharing capacity between users.
+
+    At most GENOME_REPORT_MAX_IN_FLIGHT report tasks are in flight (sent but
+    not finished) at once, and GENOME_REPORT_USER_MAX_IN_FLIGHT for any one
+    user. Free capacity goes to the most urgent request first; between
+    users with requests of the same priority, to the user with fewest tasks
+    in flight, then the one least recently served, so capacity is handed
+    out round-robin. Only one report on samples of a multi-sample file is
+    in flight at once. This runs when a request is made and when a report
+    task finishes.
+    """
+    now = django_timezone.now()
+    lost_before = now - datetime.timedelta(
+        seconds=settings.GENOME_REPORT_QUEUED_TIMEOUT)
+    dispatch = []
+    with transaction.atomic():
+        # Dispatch from one process at a time.
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                           [DISPATCH_LOCK_ID])
+        # Tasks dispatched long ago that don't hold a lease are assumed
+        # lost, so their reports' requests can be dispatched again.
+        GenomeReport.objects.filter(
+            task_in_flight=True, task_dispatched__lt=lost_before).filter(
+            Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)).update(
+            task_in_flight=False)
+        in_flight = Counter()
+        sample_files = set()
+        for user_id, genome_file_url, vcf_sample in (
+                GenomeReport.objects.filter(task_in_flight=True).values_list(
+                    'user_id', 'genome_file_url', 'vcf_sample')):
+            in_flight[user_id] += 1
+            if vcf_sample:
+                sample_files.add((user_id, genome_file_url))
+        capacity = (settings.GENOME_REPORT_MAX_IN_FLIGHT -
+                    sum(in_flight.values()))
+        if capacity <= 0:
+            return
+        waiting = OrderedDict()
+        for (genome_report_id, user_id, reprocess, priority, genome_file_url,
+             vcf_sample) in GenomeReport.objects.filter(
+                task_queued__isnull=False, task_in_flight=False).order_by(
+                '-task_priority', 'task_queued').values_list(
+                'id', 'user_id', 'task_reprocess', 'task_priority',
+                'genome_file_url', 'vcf_sample'):
+            sample_file = (user_id, genome_file_url) if vcf_sample else None
+            waiting.setdefault(user_id, deque()).append(
+                (genome_report_id, reprocess, priority, sample_file))
+        last_served = dict(GenomeReport.objects.filter(
+            user_id__in=list(waiting), task_dispatched__isnull=False).values(
+            'user_id').annotate(Max('task_dispatched')).values_list(
+            'user_id', 'task_dispatched__max'))
+        never = now - datetime.timedelta(days=365 * 100)
+        while len(dispatch) < capacity:
+            users = [user_id for user_id in waiting if in_flight[user_id] <
+                     settings.GENOME_REPORT_USER_MAX_IN_FLIGHT]
+            if not users:
+                break
+            user_id = min(users, key=lambda user_id: (
+                -waiting[user_id][0][2], in_flight[user_id],
+                last_served.get(user_id, never)))
+            genome_report_id, reprocess, priority, sample_file = (
+                waiting[user_id].popleft())
+            if not waiting[user_id]:
+                del waiting[user_id]
+            # Reports on samples of a file with a task in flight are left
+            # for that task to take over, see claim_sample_genome_reports.
+            if sample_file in sample_files:
+                continue
+            if sample_file:
+                sample_files.add(sample_file)
+            dispatch.append((genome_report_id, reprocess, priority))
+            in_flight[user_id] += 1
+            # Later than any earlier pick, so ties go round-robin.
+            last_served[user_id] = now + datetime.timedelta(
+                microseconds=len(dispatch))
+        GenomeReport.objects.filter(id__in=[d[0] for d in dispatch]).update(
+            task_dispatched=now, task_in_flight=True)
+    for genome_report_id, reprocess, priority in dispatch:
+        print("Dispatching report ID {}".format(genome_report_id))
+        try:
+            produce_genome_report.apply_async(
+                (genome_report_id,), {'reprocess': reprocess},
+                priority=priority)
+        except Exception:
+            GenomeReport.objects.filter(id=genome_report_id).update(
+                task_in_flight=False)
+            raise
+
+
+def acquire_genome_report_lease(genome_report, owner):
+    """
+    Take a report's lease for a task, unless another task holds it.
+
+    Returns True if the lease was taken (or renewed, if already held).
+    """
+    now = django_timezone.now()
+    taken = GenomeReport.objects.filter(id=genome_report.id).filter(
+        Q(lease_expires__isnull=True) | Q(lease_expires__lt=now) |
+        Q(lease_owner=owner)).update(
+        lease_owner=owner, lease_expires=now + datetime.timedelta(
+            seconds=settings.GENOME_REPORT_LEASE_SECONDS))
+    if taken:
+        genome_report.lease_owner = owner
+    return bool(taken)
+
+
+def renew_genome_report_leases(owner):
+    """
+    Extend the leases a task still holds on reports.
+    """
+    if not owner:
+        return
+    GenomeReport.objects.filter(lease_owner=owner).update(
+        lease_expires=django_timezone.now() + datetime.timedelta(
+            seconds=settings.GENOME_REPORT_LEASE_SECONDS))
+
+
+@contextmanager
+def genome_report_lease_heartbeat(owner):
+    """
+    Renew a task's leases on reports in the background while in the block.
+
+    They're renewed every GENOME_REPORT_LEASE_RENEW_INTERVAL seconds,
+    however long the work in the block goes without returning, e.g. while
+    downloading or scanning a genome file.
+    """
+    stop = threading.Event()
+
+    def renew():
+        try:
+            while not stop.wait(settings.GENOME_REPORT_LEASE_RENEW_INTERVAL):
+                renew_genome_report_leases(owner)
+        finally:
+            connection.close()
+
+    heartbeat = threading.Thread(target=renew)
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def release_genome_report_lease(genome_report_id, owner):
+    """
+    Give up a task's lease on a report, if it still holds it.
+    """
+    GenomeReport.objects.filter(
+        id=genome_report_id, lease_owner=owner).update(
+        lease_owner='', lease_expires=None)
+
+
+def end_genome_report_task(genome_report_id, lease_owner):
+    """
+    Release a finished report task's lease and capacity, and dispatch more.
+    """
+    release_genome_report_lease(genome_report_id, lease_owner)
+    GenomeReport.objects.filter(id=genome_report_id).update(
+        task_in_flight=False)
+    dispatch_genome_reports()
+
+
+def claim_sample_genome_reports(genome_report):
+    """
+    Take over waiting requests for reports on other samples of a report's file.
+
+    These are the user's reports on the same genome file URL, each with a
+    vcf_sample, that are queued but not in flight. Their leases are taken
+    for the report's task and their requests cleared. Returns the reports.
+    """
+    claimed = []
+    for sample_report in GenomeReport.objects.filter(
+            user_id=genome_report.user_id,
+            genome_file_url=genome_report.genome_file_url,
+            task_queued__isnull=False, task_in_flight=False).exclude(
+            vcf_sample='').exclude(id=genome_report.id):
+        if not acquire_genome_report_lease(sample_report,
+                                           genome_report.lease_owner):
+            continue
+        # Unless dispatched meanwhile.
+        with transaction.atomic():
+            taken = GenomeReport.objects.select_for_update().filter(
+                id=sample_report.id, task_queued__isnull=False,
+                task_in_flight=False).update(
+                task_queued=None, task_reprocess=False)
+        if taken:
+            claimed.append(sample_report)
+        else:
+            release_genome_report_lease(sample_report.id,
+                                        genome_report.lease_owner)
+    return claimed
+
+
+def produce_sample_genome_reports(genome_reports, clinvar_sig):
+    """
+    Produce reports for several samples in a genome file, reading it once.
+
+    The GenomeReports share a genome file, each reporting on its vcf_sample.
+    """
+    genome_report_ids = [r.id for r in genome_reports]
+    print("Producing genome reports for report IDs: {}".format(
+        genome_report_ids))
+    reports_by_sample = defaultdict(list)
+    for genome_report in genome_reports:
+        reports_by_sample[genome_report.vcf_sample].append(genome_report)
+    stats = Counter()
+    hits = defaultdict(list)
+    genome_in = open_genome_file(genome_reports[0])
+    try:
+        for sample, hit in scan_genome_samples(
+                genome_in, clinvar_sig, list(reports_by_sample), stats):
+            hits[sample].append(hit)
+    finally:
+        genome_in.close()
+    print_scan_stats(genome_report_ids, stats)
+    for sample, sample_reports in reports_by_sample.items():
+        for genome_report in sample_reports:
+            complete_genome_report(genome_report, hits.get(sample, []),
+                                   clinvar_sig.release, memoize=True)
+
+
+def run_genome_report(genome_report, reprocess=False):
+    """
+    Match a report's genome file against ClinVar, and update the report.
+
+    Returns True if the report was handed to a chord of subtasks, which
+    completes it (and releases its lease) in finish_genome_report.
+    """
     # Try to locally store and reuse the genome file.
     # Retrieve again if not available (e.g. due to ephemeral file storage).
-    print("Producing genome report for report ID: {}".format(genome_report_id))
-    genome_report = GenomeReport.objects.get(id=genome_report_id)
-    genome_in = open_genome_file(genome_report)
+    # With GENOME_FILE_STREAMING, the file is instead stored as it's read.
     clinvar_sig = setup_clinvar_data()
 
-    genome_curr_line = _next_line(genome_in)
+    # Unless reprocessing, apply only ClinVar changes since the report's
+    # last match, if they were recorded and its calls can be matched
+    # without reading its whole genome file (see apply_clinvar_delta).
+    if (not reprocess and genome_report.last_processed and
+            genome_report.clinvar_release and
+            genome_report.clinvar_release != clinvar_sig.release):
+        delta = load_clinvar_delta(clinvar_sig, genome_report.clinvar_release)
+        if delta and apply_clinvar_delta(genome_report, clinvar_sig, *delta):
+            return False
+
+    # Otherwise rematch in full, replacing the old variants once done.
+    # Results for the same file content and ClinVar release are reused.
+    memoized_hits = get_match_result(genome_report, clinvar_sig.release)
+    if memoized_hits is not None:
+        print("Reusing match results for report ID: {}".format(
+            genome_report.id))
+        complete_genome_report(genome_report, memoized_hits,
+                               clinvar_sig.release)
+        return False
+    # Match in the database, from the genome file's ALT allele calls.
+    if settings.GENOME_MATCH_IN_DATABASE:
+        database_match_genome_report(genome_report, clinvar_sig)
+        return False
+    # Rematch from the report's genotype fingerprint, creating it if needed.
+    if settings.GENOME_FINGERPRINTS:
+        complete_genome_report(genome_report, fingerprint_hits(
+            genome_report, clinvar_sig), clinvar_sig.release, memoize=True)
+        return False
 
-    # Skip header.
-    while genome_curr_line.startswith('#'):
-        genome_curr_line = _next_line(genome_in)
+    # Fan large files out across workers, each taking some chromosomes.
+    # Only with an indexed copy of the file, so each subtask reads just its
+    # chromosomes' parts of it (rather than all of the file). Chords need a
+    # result backend to collect subtask results.
+    if (settings.CELERY_RESULT_BACKEND and
+            settings.GENOME_REPORT_SUBTASKS > 1 and
+            settings.GENOME_FILE_INDEXING and
+            not genome_report.vcf_sample and
+            os.path.getsize(get_genome_filepath(genome_report)) >=
+            settings.GENOME_REPORT_SUBTASKS_MIN_FILE_SIZE):
+        # Index once here, rather than in every subtask.
+        get_indexed_genome_filepath(genome_report)
+        chord([
+            scan_genome_report_chromosomes.s(genome_report.id, first, last,
+                                             genome_report.lease_owner)
+            for first, last in chromosome_groups(
+                clinvar_sig, settings.GENOME_REPORT_SUBTASKS)
+        ])(finish_genome_report.s(
+            genome_report.id, clinvar_sig.release,
+            genome_report.lease_owner).on_error(fail_genome_report_chord.s(
+                genome_report_id=genome_report.id,
+                lease_owner=genome_report.lease_owner)))
+        return True
 
-    while genome_curr_line:
-        entries = genome_curr_line.rstrip().split('\t')
-        var_alleles = entries[4].split(',')
-        alleles = [entries[3]] + var_alleles
-        genotypes_idx = entries[8].split(':').index('GT')
-        genotypes = set(re.split('[|/]', entries[9].split(':')[genotypes_idx]))
-        for genotype in genotypes:
+    # Reports on other samples of the file that are waiting to be processed
+    # are produced from the same read of it.
+    if genome_report.vcf_sample:
+        sample_reports = claim_sample_genome_reports(genome_report)
+        if sample_reports:
             try:
-                var_allele = alleles[int(genotype)]
-            except ValueError:
-                continue
-            pos = entries[1]
-            chrom = CHROM_MAP[
-                REV_CHROM_INDEX[CHROM_INDEX[entries[0]]]]
-            ref_allele = entries[3]
-
-            varstring = '{}-{}-{}-{}'.format(
-                chrom, pos, ref_allele, var_allele)
-            if varstring not in clinvar_sig:
-                continue
+                produce_sample_genome_reports(
+                    [genome_report] + sample_reports, clinvar_sig)
+            finally:
+                for sample_report in sample_reports:
+                    release_genome_report_lease(sample_report.id,
+                                                genome_report.lease_owner)
+            return False
 
-            genome_vcf_line = GenomeVCFLine(vcf_line=genome_curr_line,
-                                            skip_info=True)
+    complete_genome_report(genome_report, genome_report_hits(
+        genome_report, clinvar_sig, processes=settings.GENOME_SCAN_PROCESSES,
+        checkpoint=True), clinvar_sig.release, memoize=True)
+    return False
 
-            # If it appears to be significant, store this as a GenomeVariant.
-            zygosity = get_zyg(genome_vcf_line)
-            try:
-                variant = Variant.objects.get(chromosome=chrom,
-                                              pos=pos,
-                                              ref_allele=ref_allele,
-                                              var_allele=var_allele)
-            except Variant.DoesNotExist:
-                variant = Variant(chromosome=chrom,
-                                  pos=pos,
-                                  ref_allele=ref_allele,
-                                  var_allele=var_allele,
-                                  myvariant_clinvar={},
-                                  myvariant_exac={},
-                                  myvariant_gnomad_genome={})
-                variant.save()
-
-            genome_variant, _ = GenomeVariant.objects.get_or_create(
-                genome=genome_report,
-                variant=variant,
-                zygosity=zygosity)
-
-        genome_curr_line = _next_line(genome_in)
-
-    genome_report.last_processed = django_timezone.now()
-    genome_report.save()
-    genome_report.refresh_myvariant_data()
+
+# Acknowledged once done, so the task is redelivered (and resumes from its
+# checkpoint) if the worker stops partway.
+@shared_task(bind=True, task_serializer='json', acks_late=True,
+             reject_on_worker_lost=True)
+def produce_genome_report(self, genome_report_id, reprocess=False):
+    print("Producing genome report for report ID: {}".format(genome_report_id))
+    genome_report = GenomeReport.objects.get(id=genome_report_id)
+
+    # Only one task processes a report at a time. Each run has its own lease
+    # owner: a redelivered task has the same ID, but waits for the lease of
+    # the run it replaces to be released or expire. Leases are renewed
+    # throughout a run, so are short, and a lost run's soon expires.
+    lease_owner = '{}:{}:{}'.format(socket.gethostname()[:20], os.getpid(),
+                                    uuid.uuid4().hex)
+    if not acquire_genome_report_lease(genome_report, lease_owner):
+        print("Report ID {} is being processed, retrying later".format(
+            genome_report_id))
+        raise self.retry(countdown=settings.GENOME_REPORT_LEASE_RETRY_DELAY,
+                         max_retries=None)
+    # Another task may have updated the report before the lease was taken.
+    genome_report.refresh_from_db()
+
+    handed_to_chord = False
+    try:
+        # Take over any requests queued for this report meanwhile.
+        with transaction.atomic():
+            queued = GenomeReport.objects.select_for_update().filter(
+                id=genome_report_id).values_list(
+                'task_queued', 'task_reprocess').get()
+            GenomeReport.objects.filter(id=genome_report_id).update(
+                task_queued=None, task_reprocess=False)
+        task_queued, reprocess = queued[0], reprocess or queued[1]
+        # The report may have been processed since it was queued, e.g. by
+        # the task running when this was queued.
+        if (not reprocess and task_queued and genome_report.last_processed and
+                genome_report.last_processed >= task_queued):
+            print("Report ID {} already processed since queued".format(
+                genome_report_id))
+            return
+        with genome_report_lease_heartbeat(lease_owner):
+            handed_to_chord = run_genome_report(genome_report, reprocess)
+    finally:
+        if not handed_to_chord:
+            end_genome_report_task(genome_report_id, lease_owner)
+
+
+@shared_task(task_serializer='json')
+def scan_genome_report_chromosomes(genome_report_id, first_chrom, last_chrom,
+                                   lease_owner=''):
+    """
+    Return ClinVar hits in a report's genome for a range of chromosomes.
+
+    The lease of the report task that started the chord is renewed meanwhile.
+    """
+    genome_report = GenomeReport.objects.get(id=genome_report_id)
+    renew_genome_report_leases(lease_owner)
+    with genome_report_lease_heartbeat(lease_owner):
+        clinvar_sig = setup_clinvar_data().chromosome_range(
+            first_chrom, last_chrom)
+        return list(genome_report_hits(genome_report, clinvar_sig))
+
+
+@shared_task(task_serializer='json')
+def finish_genome_report(chromosome_hits, genome_report_id,
+                         clinvar_release='', lease_owner=''):
+    """
+    Chord callback for produce_genome_report: merge and store subtask hits.
+
+    The report task that started the chord then ends, releasing its lease.
+    """
+    genome_report = GenomeReport.objects.get(id=genome_report_id)
+    try:
+        renew_genome_report_leases(lease_owner)
+        with genome_report_lease_heartbeat(lease_owner):
+            complete_genome_report(genome_report, (
+                tuple(hit) for hits in chromosome_hits for hit in hits),
+                clinvar_release, memoize=bool(clinvar_release))
+    finally:
+        if lease_owner:
+            end_genome_report_task(genome_report_id, lease_owner)
+
+
+# The report's ID and lease owner are keyword-only, so Celery calls this as
+# an old-style errback, with just the ID of the chord's callback task.
+@shared_task(task_serializer='json')
+def fail_genome_report_chord(task_id, *, genome_report_id, lease_owner):
+    """
+    Chord error callback for produce_genome_report, if a subtask failed.
+
+    The report task that started the chord then ends, releasing its lease.
+    """
+    print("Subtasks failed for report ID {} (task {})".format(
+        genome_report_id, task_id))
+    end_genome_report_task(genome_report_id, lease_owner)
+
+
+@shared_task(task_serializer='json')
+def refresh_genome_reports():
+    """
+    Queue reports not yet matched with the latest ClinVar release, in batches.
+
+    Run by Celery beat every GENOME_REFRESH_INTERVAL seconds. The release's
+    ClinVar data is set up first, and shared through the database, so
+    report tasks copy it rather than each preparing it. Stale reports are
+    then queued in ID order at bulk priority, topping up the report tasks
+    waiting or in flight to GENOME_REFRESH_BATCH_SIZE, unless the release's
+    ClinVarRefresh is paused.
+    """
+    # Keep the cached release, used to check reports are up to date, fresh.
+    latest_clinvar_release(update=True)
+    clinvar_sig = setup_clinvar_data()
+    if settings.GENOME_MATCH_IN_DATABASE:
+        db_match.load_clinvar_table(clinvar_sig)
+    release = clinvar_sig.release
+    stale = GenomeReport.objects.exclude(clinvar_release=release)
+    with transaction.atomic():
+        refresh, created = ClinVarRefresh.objects.select_for_update(
+            ).get_or_create(clinvar_release=release,
+                            defaults={'reports_total': stale.count()})
+        if created:
+            print("ClinVar release {}: refreshing {} reports".format(
+                release, refresh.reports_total))
+            # Superseded by this release.
+            ClinVarRefresh.objects.filter(finished__isnull=True).exclude(
+                id=refresh.id).update(finished=django_timezone.now())
+        if refresh.finished:
+            return
+        if refresh.paused:
+            print("ClinVar release {} refresh paused: {}".format(
+                release, refresh.progress()))
+            return
+        batch_size = settings.GENOME_REFRESH_BATCH_SIZE - (
+            GenomeReport.objects.filter(
+                Q(task_queued__isnull=False) | Q(task_in_flight=True)).count())
+        genome_report_ids = []
+        if batch_size > 0:
+            genome_report_ids = list(stale.filter(
+                id__gt=refresh.last_report_id).order_by('id').values_list(
+                'id', flat=True)[:batch_size])
+            if genome_report_ids:
+                refresh.last_report_id = genome_report_ids[-1]
+                refresh.reports_queued += len(genome_report_ids)
+            if len(genome_report_ids) < batch_size:
+                refresh.finished = django_timezone.now()
+            refresh.save()
+    # Queued once claimed, as their tasks may start straight away.
+    for genome_report_id in genome_report_ids:
+        queue_genome_report(genome_report_id, priority=PRIORITY_BULK)
+    print("ClinVar release {} refresh: {}".format(
+        release, refresh.progress()))
 
 
 @shared_task(task_serializer='json')
@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+
+from ..celery import app
+
+
+class TaskRouteTests(SimpleTestCase):
+
+    def assertRoute(self, task_name, queue, priority, options=None):
+        route = app.amqp.router.route(
+            options or {}, 'genevieve_client.tasks.' + task_name)
+        self.assertEqual(route['queue'].name, queue)
+        self.assertEqual(route['queue'].queue_arguments,
+                         {'x-max-priority': 9})
+        self.assertEqual(route['priority'], priority)
+
+    def test_parse_tasks(self):
+        self.assertRoute('produce_genome_report', 'parse', 5)
+        self.assertRoute('scan_genome_report_chromosomes', 'parse', 5)
+        self.assertRoute('finish_genome_report', 'parse', 5)
+
+    def test_annotate_tasks(self):
+        self.assertRoute('refresh_myvariant_data', 'annotate', 5)
+
+    def test_maintenance_tasks(self):
+        self.assertRoute('refresh_genome_reports', 'maintenance', 5)
+        self.assertRoute('fail_genome_report_chord', 'maintenance', 5)
+
+    def test_sent_priority_kept(self):
+        self.assertRoute('produce_genome_report', 'parse', 8,
+                         options={'priority': 8})
@@ -0,0 +1,38 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from .. import forms
+from ..models import GenevieveUser
+
+
+class GenomeUploadFormTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        GenevieveUser.objects.create(user=self.user)
+
+    def clean(self, file_samples):
+        form = forms.GenomeUploadForm(user=self.user, data={
+            'report_name': 'report',
+            'genome_file_url': 'http://example.com/genome.vcf',
+            'vcf_samples': 'S1, S2'})
+        with mock.patch.object(forms, 'genome_file_samples',
+                               return_value=file_samples) as samples:
+            form.is_valid()
+        return form, samples
+
+    def test_upload_not_enabled(self):
+        form, samples = self.clean(['S1', 'S2'])
+        samples.assert_not_called()
+        self.assertEqual(form.non_field_errors(),
+                         ['Account not authorized to upload genomes.'])
+
+    def test_samples_checked(self):
+        self.user.genevieveuser.genome_upload_enabled = True
+        self.user.genevieveuser.save()
+        form, samples = self.clean(['S1', 'S3'])
+        samples.assert_called_once_with('http://example.com/genome.vcf')
+        self.assertEqual(form.errors['vcf_samples'],
+                         ['Not in this genome file: S2'])
@@ -0,0 +1,57 @@
+import io
+
+from django.test import SimpleTestCase
+
+from ..clinvar_index import ClinVarIndex
+from ..genome_scan import scan_genome, scan_genome_numpy, vcf_sample_names
+
+GENOME_VCF = (
+    b'##fileformat=VCFv4.1\n'
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n'
+    b'1\t100\t.\tA\tG\t.\tPASS\t.\tGT\t0/1\n'
+    b'1\t150\t.\tC\tT\t.\tPASS\t.\tGT\t0/1\n'
+    b'2\t200\t.\tC\tT\t.\tPASS\t.\tGT\t1/1\n'
+    b'X\t300\t.\tG\tA\t.\tPASS\t.\tGT\t1')
+
+CLINVAR_SIG = ClinVarIndex.from_variants([
+    (1, 100, 'A', 'G'), (2, 200, 'C', 'T'), (23, 300, 'G', 'A')])
+
+
+class ScanGenomeNumpyTests(SimpleTestCase):
+
+    def assert_matches_scan_genome(self, genome_vcf, **kwargs):
+        expected = list(scan_genome(io.BytesIO(genome_vcf), CLINVAR_SIG))
+        hits = list(scan_genome_numpy(io.BytesIO(genome_vcf), CLINVAR_SIG,
+                                      **kwargs))
+        self.assertEqual(hits, expected)
+        return hits
+
+    def test_last_line_without_newline(self):
+        hits = self.assert_matches_scan_genome(GENOME_VCF)
+        self.assertEqual(hits[-1], (23, 300, 'G', 'A', 'Hem'))
+
+    def test_last_line_without_newline_small_blocks(self):
+        self.assert_matches_scan_genome(GENOME_VCF, block_size=16)
+
+    def test_last_line_with_newline(self):
+        self.assert_matches_scan_genome(GENOME_VCF + b'\n', block_size=16)
+
+
+class VcfSampleNamesTests(SimpleTestCase):
+
+    def test_sample_names(self):
+        self.assertEqual(vcf_sample_names(io.BytesIO(GENOME_VCF)), ['SAMPLE'])
+
+    def test_within_max_size(self):
+        self.assertEqual(vcf_sample_names(
+            io.BytesIO(GENOME_VCF), max_size=len(GENOME_VCF)), ['SAMPLE'])
+
+    def test_header_beyond_max_size(self):
+        with self.assertRaises(ValueError):
+            vcf_sample_names(io.BytesIO(GENOME_VCF), max_size=40)
+
+    def test_no_newline_beyond_max_size(self):
+        genome_in = io.BytesIO(b'#' * 1024 * 1024)
+        with self.assertRaises(ValueError):
+            vcf_sample_names(genome_in, max_size=1024)
+        self.assertEqual(genome_in.tell(), 1024)
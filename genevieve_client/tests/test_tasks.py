@@ -0,0 +1,454 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone as django_timezone
+
+from .. import tasks
+from ..clinvar_index import ClinVarIndex
+from ..genome_fingerprint import GenotypeFingerprint
+from ..models import (ClinVarDataFile, ClinVarRefresh, GenomeFingerprint,
+                      GenomeReport, GenomeVariant, Variant)
+
+OLD_RELEASE = 'clinvar_20260101.vcf.gz'
+NEW_RELEASE = 'clinvar_20260201.vcf.gz'
+LATER_RELEASE = 'clinvar_20260301.vcf.gz'
+
+KEPT_HIT = (1, 100, 'A', 'G', 'Het')
+REMOVED_HIT = (1, 150, 'C', 'T', 'Het')
+ADDED_HIT = (2, 200, 'C', 'T', 'Hom')
+
+CLINVAR_VARIANTS = {
+    OLD_RELEASE: [KEPT_HIT[:4], REMOVED_HIT[:4]],
+    NEW_RELEASE: [KEPT_HIT[:4], ADDED_HIT[:4]],
+    LATER_RELEASE: [],
+}
+
+
+@override_settings(GENOME_FILE_INDEXING=False, GENOME_FINGERPRINTS=False,
+                   GENOME_MATCH_IN_DATABASE=False,
+                   GENOME_REPORT_SUBTASKS=1)
+@mock.patch.object(GenomeReport, 'refresh_myvariant_data', lambda self: None)
+@mock.patch.object(tasks, 'save_match_result', lambda *args: None)
+@mock.patch.object(tasks, 'get_match_result', lambda *args: None)
+class ClinVarDeltaTests(TestCase):
+
+    def setUp(self):
+        self.clinvar_sig = ClinVarIndex.from_variants(
+            [KEPT_HIT[:4], ADDED_HIT[:4]], release=NEW_RELEASE)
+        self.delta = (
+            ClinVarIndex.from_variants([ADDED_HIT[:4]], release=NEW_RELEASE),
+            ClinVarIndex.from_variants([REMOVED_HIT[:4]],
+                                       release=NEW_RELEASE))
+        self.genome_report = GenomeReport.objects.create(
+            user=User.objects.create(username='user'), report_name='report',
+            genome_file_url='http://example.com/genome.vcf',
+            last_processed=django_timezone.now(),
+            clinvar_release=OLD_RELEASE)
+        for hit in (KEPT_HIT, REMOVED_HIT):
+            GenomeVariant.objects.create(
+                genome=self.genome_report, zygosity=hit[4],
+                variant=Variant.objects.create(
+                    chromosome=hit[0], pos=hit[1], ref_allele=hit[2],
+                    var_allele=hit[3]))
+
+    def run_genome_report(self, fingerprint, genome_hits):
+        with mock.patch.object(tasks, 'setup_clinvar_data',
+                               return_value=self.clinvar_sig), \
+                mock.patch.object(tasks, 'load_clinvar_delta',
+                                  return_value=self.delta), \
+                mock.patch.object(tasks, 'load_genome_fingerprint',
+                                  return_value=fingerprint), \
+                mock.patch.object(tasks, 'genome_report_hits',
+                                  return_value=iter(genome_hits)) as hits:
+            tasks.run_genome_report(self.genome_report)
+        return hits
+
+    def report_hits(self):
+        return sorted(
+            (gv.variant.chromosome, gv.variant.pos, gv.variant.ref_allele,
+             gv.variant.var_allele, gv.zygosity) for gv in
+            self.genome_report.genomevariant_set.select_related('variant'))
+
+    def test_delta_from_fingerprint(self):
+        fingerprint = GenotypeFingerprint.from_calls([KEPT_HIT, ADDED_HIT])
+        hits = self.run_genome_report(fingerprint, [])
+        hits.assert_not_called()
+        self.assertEqual(self.report_hits(), [KEPT_HIT, ADDED_HIT])
+        self.assertEqual(self.genome_report.clinvar_release, NEW_RELEASE)
+
+    def test_no_fingerprint_rematches_in_full(self):
+        hits = self.run_genome_report(None, [KEPT_HIT, ADDED_HIT])
+        # Scanned once, against the whole release rather than the delta.
+        hits.assert_called_once_with(
+            self.genome_report, self.clinvar_sig, processes=mock.ANY,
+            checkpoint=True)
+        self.assertEqual(self.report_hits(), [KEPT_HIT, ADDED_HIT])
+        self.assertEqual(self.genome_report.clinvar_release, NEW_RELEASE)
+
+    def test_apply_clinvar_delta_without_fingerprint(self):
+        with mock.patch.object(tasks, 'load_genome_fingerprint',
+                               return_value=None), \
+                mock.patch.object(tasks, 'genome_report_hits') as hits:
+            self.assertFalse(tasks.apply_clinvar_delta(
+                self.genome_report, self.clinvar_sig, *self.delta))
+        hits.assert_not_called()
+        self.assertEqual(self.report_hits(), [KEPT_HIT, REMOVED_HIT])
+        self.genome_report.refresh_from_db()
+        self.assertEqual(self.genome_report.clinvar_release, OLD_RELEASE)
+
+
+
+class GenomeFingerprintTests(TestCase):
+
+    def setUp(self):
+        self.genome_report = GenomeReport.objects.create(
+            user=User.objects.create(username='user'), report_name='report',
+            genome_file_url='http://example.com/genome.vcf')
+
+    def use_new_worker_storage(self):
+        local_storage_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_storage_root)
+        settings = self.settings(LOCAL_STORAGE_ROOT=local_storage_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_shared_with_other_workers(self):
+        self.use_new_worker_storage()
+        tasks.save_genome_fingerprint(
+            self.genome_report,
+            GenotypeFingerprint.from_calls([KEPT_HIT, ADDED_HIT]))
+        self.use_new_worker_storage()
+        fingerprint = tasks.load_genome_fingerprint(self.genome_report)
+        clinvar_sig = ClinVarIndex.from_variants(
+            [ADDED_HIT[:4], REMOVED_HIT[:4]])
+        self.assertEqual(list(fingerprint.matches(clinvar_sig)), [ADDED_HIT])
+
+    def test_none_for_new_genome_file(self):
+        self.use_new_worker_storage()
+        tasks.save_genome_fingerprint(
+            self.genome_report, GenotypeFingerprint.from_calls([KEPT_HIT]))
+        self.genome_report.genome_file_created = '2026-10-19T00:00:00Z'
+        self.assertIsNone(tasks.load_genome_fingerprint(self.genome_report))
+        self.assertEqual(GenomeFingerprint.objects.count(), 1)
+
+
+class MatchResultTests(SimpleTestCase):
+
+    @override_settings(GENOME_FILE_STREAMING=False)
+    def test_uncached_genome_not_retrieved(self):
+        genome_report = GenomeReport(
+            genome_file_url='http://example.com/genome.vcf')
+        with mock.patch.object(tasks, 'get_cached_genome_filepath',
+                               return_value=None), \
+                mock.patch.object(tasks, 'get_genome_filepath') as retrieve:
+            self.assertIsNone(
+                tasks.get_match_result(genome_report, NEW_RELEASE))
+        retrieve.assert_not_called()
+
+    @override_settings(GENOME_FINGERPRINTS=False,
+                       GENOME_MATCH_IN_DATABASE=False)
+    def test_filter_versions(self):
+        versions = {}
+        for name, overrides in (
+                ('lines', {'GENOME_SCAN_ENGINE': 'lines'}),
+                ('gvcf', {'GENOME_SCAN_ENGINE': 'gvcf'}),
+                ('fingerprints', {'GENOME_SCAN_ENGINE': 'gvcf',
+                                  'GENOME_FINGERPRINTS': True}),
+                ('database', {'GENOME_MATCH_IN_DATABASE': True})):
+            with self.settings(**overrides):
+                versions[name] = tasks.get_match_filter_version()
+        self.assertEqual(versions['fingerprints'], versions['database'])
+        self.assertEqual(len(set(versions.values())), 3)
+
+
+def fake_generate_clinvar_sig(clinvar_filepath, clinvar_sig_filepath, build):
+    release = os.path.basename(clinvar_filepath)[len(build) + 1:]
+    ClinVarIndex.from_variants(
+        CLINVAR_VARIANTS[release], build=build, release=release).save(
+        clinvar_sig_filepath)
+
+
+@mock.patch.object(tasks, 'download_clinvar_file', lambda *args: None)
+@mock.patch.object(tasks, 'generate_clinvar_sig',
+                   side_effect=fake_generate_clinvar_sig)
+class ClinVarDataTests(TestCase):
+
+    def setup_clinvar_data(self, release):
+        # As on a new worker, with its own local storage.
+        local_storage_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_storage_root)
+        tasks._clinvar_sig_cache.clear()
+        with self.settings(LOCAL_STORAGE_ROOT=local_storage_root), \
+                mock.patch.object(tasks, 'latest_clinvar_release',
+                                  return_value=(release, None)):
+            return tasks.setup_clinvar_data()
+
+    def test_index_shared(self, generate_clinvar_sig):
+        self.setup_clinvar_data(OLD_RELEASE)
+        clinvar_sig = self.setup_clinvar_data(OLD_RELEASE)
+        generate_clinvar_sig.assert_called_once()
+        self.assertEqual(sorted(clinvar_sig), CLINVAR_VARIANTS[OLD_RELEASE])
+        self.assertEqual(clinvar_sig.release, OLD_RELEASE)
+
+    def test_delta_from_shared_index(self, generate_clinvar_sig):
+        self.setup_clinvar_data(OLD_RELEASE)
+        self.setup_clinvar_data(NEW_RELEASE)
+        clinvar_sig = self.setup_clinvar_data(NEW_RELEASE)
+        self.assertEqual(generate_clinvar_sig.call_count, 2)
+        added, removed = tasks.load_clinvar_delta(clinvar_sig, OLD_RELEASE)
+        self.assertEqual(list(added), [ADDED_HIT[:4]])
+        self.assertEqual(list(removed), [REMOVED_HIT[:4]])
+        self.assertEqual(ClinVarDataFile.objects.filter(
+            clinvar_release=NEW_RELEASE).count(), 3)
+
+    def test_old_releases_deleted(self, generate_clinvar_sig):
+        for release in (OLD_RELEASE, NEW_RELEASE, LATER_RELEASE):
+            self.setup_clinvar_data(release)
+        self.assertEqual(
+            set(ClinVarDataFile.objects.values_list(
+                'clinvar_release', flat=True)),
+            {NEW_RELEASE, LATER_RELEASE})
+
+
+class GenomeReportTaskTests(TestCase):
+    """
+    Report tasks are recorded as sent, rather than sent.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(tasks, 'produce_genome_report',
+                                    mock.Mock())
+        self.apply_async = patcher.start().apply_async
+        self.addCleanup(patcher.stop)
+        self.users = {}
+
+    def create_report(self, username, vcf_sample='', **kwargs):
+        if username not in self.users:
+            self.users[username] = User.objects.create(username=username)
+        return GenomeReport.objects.create(
+            user=self.users[username], report_name='report',
+            genome_file_url='http://example.com/{}.vcf'.format(username),
+            vcf_sample=vcf_sample, **kwargs).id
+
+    def queue(self, username, **kwargs):
+        genome_report_id = self.create_report(username)
+        tasks.queue_genome_report(genome_report_id, **kwargs)
+        return genome_report_id
+
+    def sent(self):
+        sent = [(args[0][0], args[1]['reprocess'], kwargs['priority']) for
+                args, kwargs in self.apply_async.call_args_list]
+        self.apply_async.reset_mock()
+        return sent
+
+    def sent_ids(self):
+        return [genome_report_id for genome_report_id, _, _ in self.sent()]
+
+    def run_task(self, genome_report_id):
+        GenomeReport.objects.filter(id=genome_report_id).update(
+            task_queued=None)
+        tasks.end_genome_report_task(genome_report_id, '')
+
+
+@override_settings(GENOME_REPORT_MAX_IN_FLIGHT=4,
+                   GENOME_REPORT_USER_MAX_IN_FLIGHT=2)
+class DispatchGenomeReportsTests(GenomeReportTaskTests):
+
+    def test_user_max_in_flight(self):
+        first, second, third = [self.queue('a') for _ in range(3)]
+        self.assertEqual(self.sent_ids(), [first, second])
+        self.run_task(first)
+        self.assertEqual(self.sent_ids(), [third])
+
+    @override_settings(GENOME_REPORT_MAX_IN_FLIGHT=1)
+    def test_round_robin(self):
+        a1, a2, a3 = [self.queue('a') for _ in range(3)]
+        b1, b2 = [self.queue('b') for _ in range(2)]
+        order = self.sent_ids()
+        while order and len(order) < 5:
+            self.run_task(order[-1])
+            order += self.sent_ids()
+        self.assertEqual(order, [a1, b1, a2, b2, a3])
+
+    @override_settings(GENOME_REPORT_MAX_IN_FLIGHT=1)
+    def test_priority_order(self):
+        running = self.queue('a')
+        bulk = self.queue('b', priority=tasks.PRIORITY_BULK)
+        normal = self.queue('c')
+        interactive = self.queue('d', priority=tasks.PRIORITY_INTERACTIVE)
+        self.assertEqual(self.sent(),
+                         [(running, False, tasks.PRIORITY_NORMAL)])
+        order = []
+        for genome_report_id in (running, interactive, normal):
+            self.run_task(genome_report_id)
+            order += self.sent()
+        self.assertEqual(order, [
+            (interactive, False, tasks.PRIORITY_INTERACTIVE),
+            (normal, False, tasks.PRIORITY_NORMAL),
+            (bulk, False, tasks.PRIORITY_BULK)])
+
+    def test_one_sample_report_per_file(self):
+        s1, s2 = [self.create_report('a', vcf_sample=vcf_sample) for
+                  vcf_sample in ('S1', 'S2')]
+        other = self.create_report('a')
+        for genome_report_id in (s1, s2, other):
+            tasks.queue_genome_report(genome_report_id)
+        self.assertEqual(self.sent_ids(), [s1, other])
+        self.run_task(s1)
+        self.assertEqual(self.sent_ids(), [s2])
+
+    @override_settings(GENOME_REPORT_MAX_IN_FLIGHT=1)
+    def test_requests_merged(self):
+        running = self.queue('a')
+        waiting = self.queue('b', priority=tasks.PRIORITY_BULK)
+        tasks.queue_genome_report(waiting, reprocess=True)
+        tasks.queue_genome_report(waiting)
+        self.assertEqual(self.sent_ids(), [running])
+        self.run_task(running)
+        self.assertEqual(self.sent(), [
+            (waiting, True, tasks.PRIORITY_NORMAL)])
+
+    @override_settings(GENOME_REPORT_MAX_IN_FLIGHT=1)
+    def test_lost_task_dispatched_again(self):
+        lost = self.queue('a')
+        self.sent()
+        long_ago = django_timezone.now() - datetime.timedelta(days=2)
+        GenomeReport.objects.filter(id=lost).update(task_dispatched=long_ago)
+        tasks.dispatch_genome_reports()
+        self.assertEqual(self.sent_ids(), [lost])
+
+    @override_settings(GENOME_REPORT_MAX_IN_FLIGHT=1)
+    def test_leased_task_not_lost(self):
+        running = self.queue('a')
+        self.sent()
+        long_ago = django_timezone.now() - datetime.timedelta(days=2)
+        GenomeReport.objects.filter(id=running).update(
+            task_dispatched=long_ago, lease_owner='owner',
+            lease_expires=django_timezone.now() + datetime.timedelta(
+                minutes=1))
+        tasks.dispatch_genome_reports()
+        self.assertEqual(self.sent(), [])
+
+
+class GenomeReportLeaseTests(GenomeReportTaskTests):
+
+    def setUp(self):
+        super(GenomeReportLeaseTests, self).setUp()
+        self.genome_report = GenomeReport.objects.get(
+            id=self.create_report('a'))
+
+    def test_lease_held(self):
+        self.assertTrue(tasks.acquire_genome_report_lease(
+            self.genome_report, 'first'))
+        self.assertTrue(tasks.acquire_genome_report_lease(
+            self.genome_report, 'first'))
+        self.assertFalse(tasks.acquire_genome_report_lease(
+            self.genome_report, 'second'))
+
+    def test_expired_lease_taken(self):
+        tasks.acquire_genome_report_lease(self.genome_report, 'first')
+        GenomeReport.objects.filter(id=self.genome_report.id).update(
+            lease_expires=django_timezone.now() - datetime.timedelta(
+                seconds=1))
+        self.assertTrue(tasks.acquire_genome_report_lease(
+            self.genome_report, 'second'))
+
+    def test_leases_renewed(self):
+        tasks.acquire_genome_report_lease(self.genome_report, 'first')
+        past = django_timezone.now() - datetime.timedelta(seconds=1)
+        GenomeReport.objects.filter(id=self.genome_report.id).update(
+            lease_expires=past)
+        tasks.renew_genome_report_leases('first')
+        self.genome_report.refresh_from_db()
+        self.assertGreater(self.genome_report.lease_expires,
+                           django_timezone.now())
+
+    def test_sample_reports_claimed(self):
+        s1, s2, s3 = [GenomeReport.objects.get(id=self.create_report(
+            'b', vcf_sample=vcf_sample)) for vcf_sample in ('S1', 'S2', 'S3')]
+        for genome_report in (s2, s3):
+            GenomeReport.objects.filter(id=genome_report.id).update(
+                task_queued=django_timezone.now())
+        tasks.acquire_genome_report_lease(s3, 'other')
+        tasks.acquire_genome_report_lease(s1, 'first')
+        claimed = tasks.claim_sample_genome_reports(s1)
+        self.assertEqual([genome_report.id for genome_report in claimed],
+                         [s2.id])
+        s2.refresh_from_db()
+        self.assertEqual(s2.lease_owner, 'first')
+        self.assertIsNone(s2.task_queued)
+
+    def test_task_end(self):
+        tasks.queue_genome_report(self.genome_report.id)
+        self.sent()
+        tasks.acquire_genome_report_lease(self.genome_report, 'first')
+        tasks.end_genome_report_task(self.genome_report.id, 'first')
+        self.genome_report.refresh_from_db()
+        self.assertEqual(self.genome_report.lease_owner, '')
+        # Its request was still queued (the task didn't start), so its
+        # freed capacity goes to it again.
+        self.assertEqual(self.sent_ids(), [self.genome_report.id])
+        self.assertTrue(self.genome_report.task_in_flight)
+
+
+@override_settings(GENOME_MATCH_IN_DATABASE=False,
+                   GENOME_REFRESH_BATCH_SIZE=2,
+                   GENOME_REPORT_MAX_IN_FLIGHT=4,
+                   GENOME_REPORT_USER_MAX_IN_FLIGHT=4)
+class RefreshGenomeReportsTests(GenomeReportTaskTests):
+
+    def setUp(self):
+        super(RefreshGenomeReportsTests, self).setUp()
+        self.stale = [self.create_report('a', clinvar_release=OLD_RELEASE)
+                      for _ in range(5)]
+        self.create_report('a', clinvar_release=NEW_RELEASE)
+        for name, value in (
+                ('latest_clinvar_release', (NEW_RELEASE, None)),
+                ('setup_clinvar_data', ClinVarIndex.from_variants(
+                    [], release=NEW_RELEASE))):
+            patcher = mock.patch.object(tasks, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def refresh(self):
+        tasks.refresh_genome_reports()
+        sent = self.sent_ids()
+        GenomeReport.objects.filter(id__in=sent).update(
+            clinvar_release=NEW_RELEASE, task_queued=None,
+            task_in_flight=False)
+        return sent
+
+    def test_batches(self):
+        self.assertEqual(self.refresh(), self.stale[:2])
+        refresh = ClinVarRefresh.objects.get(clinvar_release=NEW_RELEASE)
+        self.assertEqual(refresh.reports_total, 5)
+        self.assertEqual(self.refresh(), self.stale[2:4])
+        self.assertEqual(self.refresh(), self.stale[4:])
+        self.assertEqual(self.refresh(), [])
+        refresh.refresh_from_db()
+        self.assertEqual(refresh.reports_queued, 5)
+        self.assertIsNotNone(refresh.finished)
+
+    def test_batch_tops_up(self):
+        tasks.refresh_genome_reports()
+        self.assertEqual(self.sent_ids(), self.stale[:2])
+        # Reports still in flight count towards the batch.
+        self.assertEqual(self.refresh(), [])
+
+    def test_pause_and_resume(self):
+        self.assertEqual(self.refresh(), self.stale[:2])
+        ClinVarRefresh.objects.update(paused=True)
+        self.assertEqual(self.refresh(), [])
+        ClinVarRefresh.objects.update(paused=False)
+        self.assertEqual(self.refresh(), self.stale[2:4])
+
+    def test_superseded_refresh_finished(self):
+        ClinVarRefresh.objects.create(clinvar_release=OLD_RELEASE)
+        self.refresh()
+        self.assertIsNotNone(ClinVarRefresh.objects.get(
+            clinvar_release=OLD_RELEASE).finished)
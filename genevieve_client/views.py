@@ -21,7 +21,7 @@ from django.views.generic import (DetailView, FormView, ListView,
 from .models import (GennotesEditor, GenomeReport, GenevieveUser,
                      OpenHumansUser, Variant)
 from .forms import GenomeUploadForm
-from .tasks import produce_genome_report
+from .tasks import PRIORITY_INTERACTIVE, queue_genome_report
 
 User = get_user_model()
 
@@ -325,6 +325,11 @@ class GenomeImportView(FormView):
     def dispatch(self, *args, **kwargs):
         return super(GenomeImportView, self).dispatch(*args, **kwargs)
 
+    def get_form_kwargs(self):
+        kwargs = super(GenomeImportView, self).get_form_kwargs()
+        kwargs['user'] = self.request.user
+        return kwargs
+
     def form_valid(self, form):
         # Double-check that user has permission to upload genome.
         if not self.request.user.genevieveuser.genome_upload_enabled:
@@ -333,13 +338,31 @@ class GenomeImportView(FormView):
                            'Account not authorized to upload genomes.')
             return self.form_invalid(form)
         form.user = self.request.user
+        vcf_samples = form.cleaned_data['vcf_samples']
+        if vcf_samples:
+            # One report per sample. Their tasks produce the reports still
+            # waiting together, from a single pass of the file.
+            max_length = GenomeReport._meta.get_field(
+                'report_name').max_length
+            for vcf_sample in vcf_samples:
+                suffix = ' ({})'.format(vcf_sample)
+                report_name = form.cleaned_data['report_name'][
+                    :max(max_length - len(suffix), 0)] + suffix
+                new_report = GenomeReport(
+                    genome_file_url=form.cleaned_data['genome_file_url'],
+                    user=form.user,
+                    report_name=report_name[:max_length],
+                    vcf_sample=vcf_sample)
+                new_report.save()
+                queue_genome_report(new_report.id,
+                                    priority=PRIORITY_INTERACTIVE)
+            return super(GenomeImportView, self).form_valid(form)
         new_report = GenomeReport(
             genome_file_url=form.cleaned_data['genome_file_url'],
             user=form.user,
             report_name=form.cleaned_data['report_name'])
         new_report.save()
-        produce_genome_report.delay(
-            genome_report_id=new_report.id)
+        queue_genome_report(new_report.id, priority=PRIORITY_INTERACTIVE)
         # Insert calling celery task for genome processing here.
         return super(GenomeImportView, self).form_valid(form)
 
@@ -531,9 +554,9 @@ class GenomeReportReprocessView(DetailView):
     def post(self, request, *args, **kwargs):
         genome_report = self.get_object()
 
-        # Delete old variants and create a new list.
+        # Rematch in full. Old variants are replaced once that's done.
         genome_report = GenomeReport.objects.get(pk=genome_report.id)
-        genome_report.refresh(force=True)
+        genome_report.refresh(force=True, priority=PRIORITY_INTERACTIVE)
         messages.success(request,
                          'Reprocessing initiated for "{}".'.format(
                              genome_report.report_name))